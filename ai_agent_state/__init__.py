@@ -1 +1,11 @@
-from .state import State, StateData, StateMachine, Transition, ChromaStateManager
\ No newline at end of file
+from .state import (
+    State,
+    StateData,
+    StateMachine,
+    Transition,
+    ChromaStateManager,
+    ResponseCache,
+    SemanticCache,
+    get_default_client,
+    get_default_async_client,
+)
@@ -1,38 +1,146 @@
 import time
 import random
-import json
-from typing import Dict, List, Any, Optional, Callable
-from dataclasses import dataclass, asdict, field
+import asyncio
+import orjson
+from typing import TYPE_CHECKING, Deque, Dict, List, Any, Optional, Callable, Iterable, Mapping, Tuple
+from dataclasses import MISSING, dataclass, field, fields
 import uuid
+import hashlib
+import types
+import weakref
+from collections import Counter, OrderedDict, defaultdict, deque
+from itertools import islice
 from datetime import datetime
 import threading
 import os
+import sys
+import importlib.util
 from dotenv import load_dotenv
-# Import for ChromaDB
-import chromadb
-from chromadb.utils import embedding_functions
+# chromadb, openai and httpx are slow to import, so they are imported on first use
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+def _json_dumps(obj: Any) -> str:
+    # orjson is several times faster than json.dumps; Chroma metadata needs str, not bytes
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+_default_client: Optional['OpenAI'] = None
+# An httpx async pool is bound to the event loop it was first used on, so keep one client per loop
+_default_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]' = weakref.WeakKeyDictionary()
+_default_client_lock = threading.Lock()
+
+def _http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None  # HTTP/2 needs the optional h2 package
+
+def get_default_client() -> 'OpenAI':
+    """Return the process-wide OpenAI client, creating it on first use.
+
+    Sharing one client keeps its HTTP connection pool (and TLS sessions) alive
+    across transitions instead of reconnecting for every turn.
+    """
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                import httpx
+                from openai import OpenAI
+
+                load_dotenv()  # Read OPENAI_API_KEY from .env only once a client is needed
+                http_client = httpx.Client(
+                    http2=_http2_available(),
+                    limits=httpx.Limits(max_keepalive_connections=10)
+                )
+                _default_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=http_client)
+    return _default_client
+
+def get_default_async_client() -> 'AsyncOpenAI':
+    """Return the AsyncOpenAI client for the running event loop, creating it on first use.
+
+    Must be called from a coroutine. Its connection pool is tied to that loop, so each
+    loop (e.g. each ``asyncio.run`` call) gets its own client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _default_async_clients.get(loop)
+    if client is None:
+        with _default_client_lock:
+            # Clients of closed loops can never be used again
+            for closed_loop in [other for other in _default_async_clients if other.is_closed()]:
+                del _default_async_clients[closed_loop]
+            client = _default_async_clients.get(loop)
+            if client is None:
+                import httpx
+                from openai import AsyncOpenAI
+
+                load_dotenv()  # Read OPENAI_API_KEY from .env only once a client is needed
+                http_client = httpx.AsyncClient(
+                    http2=_http2_available(),
+                    limits=httpx.Limits(max_keepalive_connections=10)
+                )
+                client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=http_client)
+                _default_async_clients[loop] = client
+    return client
+
+def _discard_task_result(task: 'asyncio.Future') -> None:
+    if not task.cancelled():
+        task.exception()
+
+def _now_ns() -> int:
+    # Truncated to microseconds, the resolution isoformat() can represent
+    return time.time_ns() // 1000 * 1000
 
-# Load environment variables
-load_dotenv()
+def _ns_to_iso(timestamp_ns: int) -> str:
+    seconds, remainder = divmod(timestamp_ns, 1_000_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=remainder // 1000).isoformat()
 
-@dataclass
+def _iso_to_ns(value: Any) -> int:
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value)
+        return int(parsed.replace(microsecond=0).timestamp()) * 1_000_000_000 + parsed.microsecond * 1000
+    return value
+
+# dataclass(slots=True) needs Python 3.10+; older interpreters keep a per-instance __dict__
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(**_SLOTS)
 class Metadata:
-    created_at: str = field(default_factory=lambda: datetime.now().isoformat())
-    updated_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    # Stored as nanoseconds since the epoch; formatted as ISO 8601 only when serialized
+    created_at: int = field(default_factory=_now_ns)
+    updated_at: int = field(default_factory=_now_ns)
     llm_response: Optional[str] = None
     custom_data: Dict[str, Any] = field(default_factory=dict)
     llm_prompt: Optional[str] = None
     llm_response_time: Optional[float] = None
     llm_tokens_used: Optional[int] = None
 
+    @property
+    def created_at_iso(self) -> str:
+        return _ns_to_iso(self.created_at)
+
+    @property
+    def updated_at_iso(self) -> str:
+        return _ns_to_iso(self.updated_at)
+
     def to_dict(self) -> Dict[str, Any]:
-        return asdict(self)
+        # Built by hand: asdict() deep-copies every field recursively
+        return {
+            "created_at": self.created_at_iso,
+            "updated_at": self.updated_at_iso,
+            "llm_response": self.llm_response,
+            "custom_data": dict(self.custom_data),
+            "llm_prompt": self.llm_prompt,
+            "llm_response_time": self.llm_response_time,
+            "llm_tokens_used": self.llm_tokens_used,
+        }
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'Metadata':
+        data = dict(data)
+        for key in ("created_at", "updated_at"):
+            if key in data:
+                data[key] = _iso_to_ns(data[key])
         return cls(**data)
 
-@dataclass
+@dataclass(**_SLOTS)
 class StateData:
     data: Dict[str, Any] = field(default_factory=dict)
     metadata: Metadata = field(default_factory=Metadata)
@@ -44,13 +152,15 @@ class StateData:
     def from_dict(cls, data: Dict[str, Any]) -> 'StateData':
         return cls(data=data["data"], metadata=Metadata.from_dict(data["metadata"]))
 
-    def update_metadata(self, llm_response: Optional[str] = None, **kwargs) -> None:
-        self.metadata.updated_at = datetime.now().isoformat()
+    def update_metadata(self, llm_response: Optional[str] = None, llm_prompt: Optional[str] = None, **kwargs) -> None:
+        self.metadata.updated_at = _now_ns()
         if llm_response:
             self.metadata.llm_response = llm_response
+        if llm_prompt:
+            self.metadata.llm_prompt = llm_prompt
         self.metadata.custom_data.update(kwargs)
 
-@dataclass
+@dataclass(**_SLOTS)
 class State:
     id: str
     name: str
@@ -63,7 +173,46 @@ class State:
     def from_dict(cls, data: Dict[str, Any]) -> 'State':
         return cls(id=data["id"], name=data["name"], data=StateData.from_dict(data["data"]))
 
-@dataclass
+def _build_state_loader() -> Callable[[Dict[str, Any]], State]:
+    """Generate a loader for serialized states, specialized to the current fields.
+
+    The nested State/StateData/Metadata.from_dict calls are unrolled into a single
+    function that passes positional arguments, which is noticeably faster when
+    reconstructing large state machines.
+    """
+    namespace: Dict[str, Any] = {
+        "State": State,
+        "StateData": StateData,
+        "Metadata": Metadata,
+        "_iso_to_ns": _iso_to_ns,
+    }
+    metadata_args = []
+    for f in fields(Metadata):
+        if f.default_factory is not MISSING:
+            namespace[f"_default_{f.name}"] = f.default_factory
+            default = f"_default_{f.name}()"
+        else:
+            namespace[f"_default_{f.name}"] = f.default
+            default = f"_default_{f.name}"
+        value = f"m[{f.name!r}]"
+        if f.name in ("created_at", "updated_at"):
+            value = f"_iso_to_ns({value})"
+        metadata_args.append(f"{value} if {f.name!r} in m else {default}")
+
+    source = (
+        "def _load_state(d):\n"
+        "    state_data = d['data']\n"
+        "    m = state_data['metadata']\n"
+        "    return State(d['id'], d['name'], StateData(state_data['data'], Metadata(\n"
+        + "".join(f"        {arg},\n" for arg in metadata_args)
+        + "    )))\n"
+    )
+    exec(compile(source, "<generated state loader>", "exec"), namespace)
+    return namespace["_load_state"]
+
+_load_state = _build_state_loader()
+
+@dataclass(frozen=True, **_SLOTS)
 class Transition:
     from_state: str
     to_state: str
@@ -109,8 +258,41 @@ class SetNextState:
             "required": ["next_state"]
         }
 
+CONVERSATION_HISTORY_SIZE = 10  # Turns kept in memory and persisted
+PROMPT_HISTORY_TURNS = 5  # Turns replayed to the model
+STATE_HISTORY_SIZE = 200  # States remembered for move_to_previous_state
+
+# Tools the assistant can call alongside its reply. Kept constant so it stays part of
+# the cacheable prompt prefix.
+TRANSITION_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "set_next_state",
+            "description": "Sets the next state of the state machine.",
+            "parameters": SetNextState.model_json_schema(),
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "move_to_previous_state",
+            "description": "Moves the state machine to the previous state.",
+            "parameters": {"type": "object", "properties": {}}
+        }
+    }
+]
+
 class StateMachine:
-    def __init__(self, name: str, initial_state: State, model_client: Any, model_name: Optional[str] = None):
+    def __init__(
+        self,
+        name: str,
+        initial_state: State,
+        model_client: Any = None,
+        model_name: Optional[str] = None,
+        response_cache: Optional['ResponseCache'] = None,
+        send_prompt_cache_key: Optional[bool] = None
+    ):
         self.lock = threading.Lock()
         self.id = str(uuid.uuid4())
         self.name = name
@@ -118,10 +300,31 @@ class StateMachine:
         self.states = {initial_state.name: initial_state}
         self.transitions: List[Transition] = []
         self.children: Dict[str, 'StateMachine'] = {}
-        self.conversation_history: List[Dict[str, Any]] = []
-        self.state_history: List[str] = [initial_state.name]  # New: Track state history
-        self.model_client = model_client
+        self.conversation_history: Deque[Dict[str, Any]] = deque(maxlen=CONVERSATION_HISTORY_SIZE)
+        self.state_history: Deque[str] = deque([initial_state.name], maxlen=STATE_HISTORY_SIZE)  # New: Track state history
+        self.model_client = model_client  # Falls back to get_default_client() when None
         self.model_name = model_name or os.getenv('OPENAI_MODEL', 'gpt-4o')  # Default model
+        self.response_cache = response_cache  # Optional semantic cache of LLM decisions
+        self.send_prompt_cache_key = send_prompt_cache_key  # None: only to api.openai.com
+        # Content-addressed prompts; state metadata only keeps the digest in llm_prompt.
+        # ChromaStateManager persists them in their own collection, outside to_dict().
+        self._prompt_blobs: Dict[str, str] = {}
+        self._prompt_refcounts: 'Counter[str]' = Counter()  # States referring to each digest
+        self._states_version = 0  # Bumped whenever the set of states changes
+        self._system_prompt_cache: Optional[str] = None
+        self._prefix_key: Optional[Tuple[int, int]] = None
+        self._prefix_cache: List[Dict[str, Any]] = []
+        self._prompt_cache_key: Optional[str] = None
+        self._views_version = -1
+        self._state_names: Tuple[str, ...] = ()
+        self._state_name_set: frozenset = frozenset()
+        self._viewed_states: Optional[Dict[str, State]] = None
+        self._state_index: Dict[str, int] = {}
+        self._states_view: Mapping[str, State] = types.MappingProxyType(self.states)
+        self._transitions_version = 0  # Bumped whenever the transitions change
+        self._transitions_index_version = -1
+        self._indexed_transitions: List[Transition] = []
+        self._transitions_by_from: Dict[str, List[Transition]] = {}
 
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -131,23 +334,100 @@ class StateMachine:
             "states": {name: state.to_dict() for name, state in self.states.items()},
             "transitions": [t.to_dict() for t in self.transitions],
             "children": {name: child.to_dict() for name, child in self.children.items()},
-            "conversation_history": self.conversation_history[-10:]  # Only store last 10 turns
+            "conversation_history": list(self.conversation_history)
         }
 
     @classmethod
-    def from_dict(cls, data: Dict[str, Any], model_client: Any) -> 'StateMachine':
-        initial_state = State.from_dict(data["states"][data["current_state"]])
-        sm = cls(data["name"], initial_state, model_client=model_client)
+    def from_dict(cls, data: Dict[str, Any], model_client: Any = None) -> 'StateMachine':
+        states = {name: _load_state(state_data) for name, state_data in data["states"].items()}
+        sm = cls(data["name"], states[data["current_state"]], model_client=model_client)
         sm.id = data["id"]
-        sm.states = {name: State.from_dict(state_data) for name, state_data in data["states"].items()}
+        sm.states = states
+        sm._states_version += 1
         sm.transitions = [Transition.from_dict(t) for t in data["transitions"]]
+        sm._transitions_version += 1
         sm.children = {name: StateMachine.from_dict(child_data, model_client) for name, child_data in data["children"].items()}
-        sm.conversation_history = data.get("conversation_history", [])
+        sm.conversation_history = deque(data.get("conversation_history", []), maxlen=CONVERSATION_HISTORY_SIZE)
+        sm._prompt_refcounts = Counter(
+            state.data.metadata.llm_prompt for state in states.values()
+            if state.data.metadata.llm_prompt and not state.data.metadata.llm_prompt.startswith("[")
+        )
+        sm._prompt_blobs = dict(data.get("prompt_blobs", {}))  # Inlined by earlier versions
         return sm
 
+    def _store_prompt(self, messages: List[Dict[str, Any]]) -> str:
+        prompt = orjson.dumps(messages)
+        ref = hashlib.blake2b(prompt, digest_size=16).hexdigest()
+        self._prompt_blobs.setdefault(ref, prompt.decode())
+        self._prompt_refcounts[ref] += 1
+        return ref
+
+    def _release_prompt(self, ref: Optional[str]) -> None:
+        # Drop a blob once no state's metadata refers to it any more
+        if self._prompt_refcounts[ref] > 1:
+            self._prompt_refcounts[ref] -= 1
+        else:
+            self._prompt_refcounts.pop(ref, None)
+            self._prompt_blobs.pop(ref, None)
+
+    def _referenced_prompts(self) -> Dict[str, str]:
+        return {ref: self._prompt_blobs[ref] for ref in self._prompt_refcounts if ref in self._prompt_blobs}
+
+    def get_prompt(self, prompt_ref: Optional[str]) -> Optional[str]:
+        """Return the prompt JSON stored under a metadata ``llm_prompt`` reference."""
+        if prompt_ref is None:
+            return None
+        if prompt_ref.startswith("["):
+            return prompt_ref  # Older metadata stored the prompt inline
+        return self._prompt_blobs.get(prompt_ref)
+
+    def _refresh_state_views(self) -> None:
+        # add_state(s) and from_dict bump the version; checking the dict's identity and key
+        # set also catches direct edits of the public states dict
+        if self._views_version == self._states_version and (
+            self._viewed_states is not self.states or self.states.keys() != self._state_name_set
+        ):
+            self._states_version += 1
+        if self._views_version != self._states_version:
+            self._state_names = tuple(self.states.keys())
+            self._state_name_set = frozenset(self._state_names)
+            self._state_index = {name: index for index, name in enumerate(self._state_names)}
+            self._states_view = types.MappingProxyType(self.states)
+            self._viewed_states = self.states
+            self._views_version = self._states_version
+
+    @property
+    def state_names(self) -> Tuple[str, ...]:
+        """Names of all states, in insertion order."""
+        self._refresh_state_views()
+        return self._state_names
+
+    def is_valid_state(self, name: Optional[str]) -> bool:
+        """Whether ``name`` is one of the machine's states."""
+        return name in self.states  # O(1), and always current even after direct edits of states
+
+    @property
+    def state_index(self) -> Mapping[str, int]:
+        """Position of each state name in ``state_names``."""
+        self._refresh_state_views()
+        return types.MappingProxyType(self._state_index)
+
+    @property
+    def states_view(self) -> Mapping[str, State]:
+        """Read-only view of ``states``."""
+        self._refresh_state_views()
+        return self._states_view
+
     def add_state(self, state: State) -> None:
         with self.lock:
             self.states[state.name] = state
+            self._states_version += 1
+
+    def add_states(self, states: Iterable[State]) -> None:
+        """Add several states at once; derived views are invalidated only once."""
+        with self.lock:
+            self.states.update((state.name, state) for state in states)
+            self._states_version += 1
 
     def add_transition(self, transition: Transition) -> None:
         with self.lock:
@@ -158,34 +438,81 @@ class StateMachine:
                 to_state=transition.from_state
             )
             self.transitions.append(reverse_transition)
+            self._transitions_version += 1
 
-    def generate_messages(self, user_input: str) -> List[Dict[str, Any]]:
-        messages = []
-
-        system_message = {
-            "role": "system",
-            "content": (
+    def add_transitions(self, transitions: Iterable[Transition]) -> None:
+        """Add several transitions (and their reverse transitions) in one call."""
+        with self.lock:
+            new_transitions = []
+            for transition in transitions:
+                new_transitions.append(transition)
+                new_transitions.append(Transition(
+                    from_state=transition.to_state,
+                    to_state=transition.from_state
+                ))
+            self.transitions.extend(new_transitions)
+            self._transitions_version += 1
+
+    def _transition_graph_description(self) -> str:
+        self._refresh_transition_index()
+        edges = "; ".join(
+            f"{from_state} -> {', '.join(dict.fromkeys(t.to_state for t in transitions))}"
+            for from_state, transitions in self._transitions_by_from.items()
+        )
+        return f"Transitions between states: {edges}." if edges else "No transitions are defined."
+
+    def _static_prefix(self) -> List[Dict[str, Any]]:
+        # The prefix only depends on the states and transitions, so it is rebuilt only when
+        # they change and is otherwise reused byte-for-byte, which lets the provider cache it.
+        self._refresh_state_views()
+        self._refresh_transition_index()
+        prefix_key = (self._states_version, self._transitions_version)
+        if self._prefix_key != prefix_key:
+            self._system_prompt_cache = (
                 f"You are an assistant that manages a state machine for a conversation. "
-                f"Available states are: {', '.join(self.states.keys())}. "
-                "After responding to the user, you must decide the next state by calling the 'set_next_state' function "
-                "with the parameter 'next_state' set to one of the available states. "
-                "Respond to the user appropriately before calling the function."
+                f"Available states are: {', '.join(self.state_names)}. "
+                "Respond with the user-facing reply as message content AND call the 'set_next_state' function "
+                "in the same response, with the parameter 'next_state' set to one of the available states."
             )
-        }
-        messages.append(system_message)
+            graph_description = self._transition_graph_description()
+            self._prefix_cache = [
+                {"role": "system", "content": self._system_prompt_cache},
+                {"role": "system", "content": graph_description},
+            ]
+            self._prompt_cache_key = hashlib.sha256(
+                f"{self._system_prompt_cache}\n{graph_description}".encode("utf-8")
+            ).hexdigest()[:32]
+            self._prefix_key = prefix_key
+        return self._prefix_cache
+
+    def _dynamic_suffix(self, user_input: str) -> List[Dict[str, Any]]:
+        messages = []
 
-        for turn in self.conversation_history[-5:]:  # Only use last 5 turns
+        recent_turns = list(islice(reversed(self.conversation_history), PROMPT_HISTORY_TURNS))
+        for turn in reversed(recent_turns):
             if 'user_input' in turn:
                 messages.append({"role": "user", "content": turn['user_input']})
-            if 'assistant_response' in turn:
+            if 'tool_call' in turn:
+                messages.append({
+                    "role": "assistant",
+                    "content": turn.get('assistant_response') or None,
+                    "tool_calls": [turn['tool_call']]
+                })
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": turn['tool_call']['id'],
+                    "content": turn['function_response']
+                })
+            elif 'assistant_response' in turn:
                 messages.append({"role": "assistant", "content": turn['assistant_response']})
+            # Turns recorded with the legacy functions API
             if 'function_call' in turn:
                 messages.append({
                     "role": "assistant",
                     "content": None,
                     "function_call": turn['function_call']
                 })
-            if 'function_response' in turn:
+            if 'function_response' in turn and 'tool_call' not in turn:
                 messages.append({
                     "role": "function",
                     "name": turn['function_name'],
@@ -197,110 +524,193 @@ class StateMachine:
 
         return messages
 
+    def generate_messages(self, user_input: str) -> List[Dict[str, Any]]:
+        return self._static_prefix() + self._dynamic_suffix(user_input)
+
     def move_to_previous_state(self) -> None:
         with self.lock:
-            if len(self.state_history) > 1:
-                self.state_history.pop()  # Remove current state
-                previous_state_name = self.state_history[-1]
-                self.current_state = self.states[previous_state_name]
-                print(f"Moved back to state: {previous_state_name}")
+            self._move_to_previous_state()
+
+    def _move_to_previous_state(self) -> None:
+        if len(self.state_history) > 1:
+            self.state_history.pop()  # Remove current state
+            previous_state_name = self.state_history[-1]
+            self.current_state = self.states[previous_state_name]
+            print(f"Moved back to state: {previous_state_name}")
+        else:
+            print("Cannot move back. Already at the initial state.")
+
+    def _lookup_cached_response(self, state_name: str, user_input: str) -> Optional[Dict[str, Any]]:
+        if self.response_cache is None:
+            return None
+        cached = self.response_cache.lookup(state_name, user_input)
+        if cached and self.is_valid_state(cached["next_state"]):
+            return cached
+        return None
+
+    def _apply_cached_response(self, user_input: str, cached: Dict[str, Any]) -> None:
+        next_state_name = cached["next_state"]
+        self.current_state = self.states[next_state_name]
+        self.state_history.append(next_state_name)
+        # Give the replayed call a fresh id so every tool message answers a unique call
+        tool_call = dict(cached["tool_call"], id=f"call_{uuid.uuid4().hex}")
+        self.conversation_history.append({
+            "user_input": user_input,
+            "assistant_response": cached["assistant_response"],
+            "tool_call": tool_call,
+            "function_response": f"State changed to {next_state_name}",
+            "function_name": "set_next_state"
+        })
+
+    def _sends_prompt_cache_key(self, model_client: Any) -> bool:
+        if self.send_prompt_cache_key is not None:
+            return self.send_prompt_cache_key
+        # prompt_cache_key is an OpenAI API field; compatible servers (vLLM, llama.cpp, ...) may reject it
+        host = getattr(getattr(model_client, "base_url", None), "host", None)
+        return isinstance(host, str) and host.endswith("openai.com")
+
+    def _completion_kwargs(self, messages: List[Dict[str, Any]], model_client: Any) -> Dict[str, Any]:
+        # A single call returns both the user-facing reply and the tool call
+        kwargs = {
+            "model": self.model_name,
+            "messages": messages,
+            "tools": TRANSITION_TOOLS,
+            "tool_choice": "auto",  # Let the assistant decide whether to call a tool
+        }
+        if self._sends_prompt_cache_key(model_client):
+            # Sent as a raw body field so SDK versions without the keyword argument still work
+            kwargs["extra_body"] = {"prompt_cache_key": self._prompt_cache_key}
+        return kwargs
+
+    def _apply_response(
+        self,
+        source_state_name: str,
+        user_input: str,
+        messages: List[Dict[str, Any]],
+        response_message: Any
+    ) -> Optional[Dict[str, Any]]:
+        # Must be called with self.lock held. Returns the entry to add to the response
+        # cache, if any, so the caller can store it after releasing the lock.
+        assistant_response = (response_message.content or "").strip()
+        cache_entry = None
+
+        if response_message.tool_calls:
+            tool_call = response_message.tool_calls[0]
+            function_name = tool_call.function.name
+            arguments = orjson.loads(tool_call.function.arguments or "{}")
+
+            if function_name == "set_next_state":
+                next_state_name = arguments.get("next_state")
+                if self.is_valid_state(next_state_name):
+                    self.current_state = self.states[next_state_name]
+                    self.state_history.append(next_state_name)  # Add to history
+                    previous_prompt_ref = self.current_state.data.metadata.llm_prompt
+                    self.current_state.data.update_metadata(
+                        llm_response=_json_dumps(response_message.model_dump()),
+                        llm_prompt=self._store_prompt(messages)
+                    )
+                    self._release_prompt(previous_prompt_ref)
+                    function_response = f"State changed to {next_state_name}"
+
+                    if self.response_cache is not None:
+                        cache_entry = {
+                            "state_name": source_state_name,
+                            "user_input": user_input,
+                            "next_state": next_state_name,
+                            "assistant_response": assistant_response,
+                            "tool_call": tool_call.model_dump()
+                        }
+                else:
+                    raise ValueError(f"Invalid next state: {next_state_name}")
+            elif function_name == "move_to_previous_state":
+                self._move_to_previous_state()
+                function_response = f"Moved back to state: {self.current_state.name}"
             else:
-                print("Cannot move back. Already at the initial state.")
+                raise ValueError(f"Unknown function: {function_name}")
+
+            # Append the reply, tool call and its result to conversation history
+            self.conversation_history.append({
+                "user_input": user_input,
+                "assistant_response": assistant_response,
+                "tool_call": tool_call.model_dump(),
+                "function_response": function_response,
+                "function_name": function_name
+            })
+        else:
+            # The assistant didn't call any tool
+            self.conversation_history.append({
+                "user_input": user_input,
+                "assistant_response": assistant_response
+            })
+
+        return cache_entry
 
     def trigger_transition(self, user_input: str) -> None:
+        # The lock only guards reading and mutating the machine; the model call and the
+        # cache round trips run without it so other threads are not blocked meanwhile.
         with self.lock:
+            source_state_name = self.current_state.name
             messages = self.generate_messages(user_input)
 
-            # Update the function that the assistant can call
-            functions = [
-                {
-                    "name": "set_next_state",
-                    "description": "Sets the next state of the state machine.",
-                    "parameters": SetNextState.model_json_schema(),
-                },
-                {
-                    "name": "move_to_previous_state",
-                    "description": "Moves the state machine to the previous state.",
-                    "parameters": {"type": "object", "properties": {}}
-                }
-            ]
+        # Reuse a previous decision for a near-identical input in the same state
+        cached = self._lookup_cached_response(source_state_name, user_input)
+        if cached:
+            with self.lock:
+                self._apply_cached_response(user_input, cached)
+            return
 
-            try:
-                response = self.model_client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    functions=functions,
-                    function_call="auto",  # Let the assistant decide whether to call the function
-                )
+        try:
+            model_client = self.model_client if self.model_client is not None else get_default_client()
+            response = model_client.chat.completions.create(**self._completion_kwargs(messages, model_client))
+            with self.lock:
+                cache_entry = self._apply_response(source_state_name, user_input, messages, response.choices[0].message)
 
-                response_message = response.choices[0].message
-
-                if response_message.function_call:
-                    function_name = response_message.function_call.name
-                    arguments = json.loads(response_message.function_call.arguments)
-
-                    if function_name == "set_next_state":
-                        next_state_name = arguments.get("next_state")
-                        if next_state_name and next_state_name in self.states:
-                            self.current_state = self.states[next_state_name]
-                            self.state_history.append(next_state_name)  # Add to history
-                            self.current_state.data.update_metadata(
-                                llm_response=json.dumps(response_message.model_dump()),
-                                llm_prompt=json.dumps(messages)
-                            )
-                            function_response = f"State changed to {next_state_name}"
-
-                            # Append the function call and response to conversation history
-                            self.conversation_history.append({
-                                "user_input": user_input,
-                                "function_call": response_message.function_call.model_dump(),
-                                "function_response": function_response,
-                                "function_name": function_name
-                            })
-
-                            # Include the function response in messages
-                            new_messages = messages + [{
-                                "role": "function",
-                                "name": function_name,
-                                "content": function_response
-                            }]
-
-                            # Call the model again to get the assistant's final response
-                            second_response = self.model_client.chat.completions.create(
-                                model=os.getenv('OPENAI_MODEL', 'gpt-4o'),
-                                messages=new_messages
-                            )
-
-                            second_response_message = second_response.choices[0].message
-                            assistant_response = second_response_message.content.strip()
-
-                            # Append the assistant's final response to conversation history
-                            self.conversation_history.append({
-                                "assistant_response": assistant_response
-                            })
-
-                            #print("Assistant Response:", assistant_response)
-                        else:
-                            raise ValueError(f"Invalid next state: {next_state_name}")
-                    elif function_name == "move_to_previous_state":
-                        self.move_to_previous_state()
-                        function_response = f"Moved back to state: {self.current_state.name}"
-                        # ... update conversation history and get final response ...
-                    else:
-                        raise ValueError(f"Unknown function: {function_name}")
-                else:
-                    # The assistant didn't call any function
-                    assistant_response = response_message.content.strip()
-                    self.conversation_history.append({
-                        "user_input": user_input,
-                        "assistant_response": assistant_response
-                    })
-                    #print("Assistant Response:", assistant_response)
-
-            except Exception as e:
-                print(f"Error in trigger_transition: {e}")
-                raise 
-                # Handle the error appropriately, e.g., set to a default state
+        except Exception as e:
+            print(f"Error in trigger_transition: {e}")
+            raise 
+            # Handle the error appropriately, e.g., set to a default state
+
+        if cache_entry is not None:
+            self.response_cache.store(**cache_entry)
+
+    async def atrigger_transition(self, user_input: str) -> None:
+        """Async variant of trigger_transition for an ``AsyncOpenAI``-style model client.
+
+        The model call is started straight away and the response cache is checked in a
+        worker thread meanwhile; on a cache hit the pending model call is cancelled.
+        """
+        with self.lock:
+            source_state_name = self.current_state.name
+            messages = self.generate_messages(user_input)
+        model_client = self.model_client if self.model_client is not None else get_default_async_client()
+        completion = asyncio.ensure_future(model_client.chat.completions.create(**self._completion_kwargs(messages, model_client)))
+
+        try:
+            if self.response_cache is not None:
+                loop = asyncio.get_running_loop()
+                cached = await loop.run_in_executor(None, self._lookup_cached_response, source_state_name, user_input)
+                if cached:
+                    with self.lock:
+                        self._apply_cached_response(user_input, cached)
+                    return
+
+            response = await completion
+            with self.lock:
+                cache_entry = self._apply_response(source_state_name, user_input, messages, response.choices[0].message)
+
+        except Exception as e:
+            print(f"Error in atrigger_transition: {e}")
+            raise
+        finally:
+            # Retrieve a result we no longer wait for, so a failed call is not logged as unhandled
+            if completion.done():
+                _discard_task_result(completion)
+            else:
+                completion.cancel()
+                completion.add_done_callback(_discard_task_result)
+
+        if cache_entry is not None:
+            self.response_cache.store(**cache_entry)
 
     def visualize(self, filename: str) -> None:
         try:
@@ -316,28 +726,116 @@ class StateMachine:
             dot.edge(transition.from_state, transition.to_state)
         dot.render(filename)
 
+    def _refresh_transition_index(self) -> None:
+        # add_transition(s) and from_dict bump the version; comparing with the indexed copy
+        # (identity first, so cheap) also catches direct edits of the public list
+        if (self._transitions_index_version == self._transitions_version
+                and self._indexed_transitions != self.transitions):
+            self._transitions_version += 1
+        if self._transitions_index_version != self._transitions_version:
+            by_from = defaultdict(list)
+            for transition in self.transitions:
+                by_from[transition.from_state].append(transition)
+            self._transitions_by_from = dict(by_from)
+            self._indexed_transitions = list(self.transitions)
+            self._transitions_index_version = self._transitions_version
+
+    def transitions_from(self, state_name: str) -> List[Transition]:
+        """Transitions leaving ``state_name``, in the order they were added."""
+        self._refresh_transition_index()
+        return self._transitions_by_from.get(state_name, [])
+
     def find_valid_transitions(self, user_input: str) -> List[Transition]:
         valid_transitions = []
-        for transition in self.transitions:
-            if transition.from_state == self.current_state.name:
-                if transition.condition:
-                    # Pass necessary context or data to the condition function
-                    if transition.condition(user_input, self):
-                        valid_transitions.append(transition)
-                else:
+        for transition in self.transitions_from(self.current_state.name):
+            if transition.condition:
+                # Pass necessary context or data to the condition function
+                if transition.condition(user_input, self):
                     valid_transitions.append(transition)
+            else:
+                valid_transitions.append(transition)
         return valid_transitions
 
+# Index settings for the small collections used here: cosine distance, fewer
+# neighbours per node and a low search ef. Chroma only applies them to new collections.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 8,
+    "hnsw:construction_ef": 64,
+    "hnsw:search_ef": 32,
+}
+
+def _collection_space(collection: Any) -> str:
+    # Collections created before HNSW_METADATA keep their original space (Chroma's default is l2)
+    configuration = collection.configuration
+    if isinstance(configuration, Mapping):
+        for index in ("hnsw", "spann"):
+            space = (configuration.get(index) or {}).get("space")
+            if isinstance(space, str):
+                return space
+    return HNSW_METADATA["hnsw:space"]
+
+def _distance_to_similarity(distance: float, space: str) -> float:
+    if space == "l2":
+        # Chroma reports squared L2; for the unit-length sentence embeddings used here
+        # that is 2 - 2 * cosine similarity
+        return 1 - distance / 2
+    return 1 - distance  # cosine and ip distances are both 1 - (cosine) similarity
+
+# int8-quantized ONNX export of all-MiniLM-L6-v2, using VNNI dot products on recent x86 CPUs
+QUANTIZED_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Collection holding prompt JSON by digest, and the constant vector stored in place of an embedding
+PROMPT_COLLECTION_NAME = "prompt_blobs"
+PROMPT_PLACEHOLDER_EMBEDDING = [0.0]
+
+_quantized_embedding_function_class: Optional[type] = None
+
+def _quantized_embedding_function() -> Any:
+    # SentenceTransformerEmbeddingFunction caches loaded models in a class-level dict keyed
+    # only by model_name, so asking it for the ONNX export would return whichever variant of
+    # all-MiniLM-L6-v2 was loaded first. A subclass with its own cache keeps them apart.
+    global _quantized_embedding_function_class
+    if _quantized_embedding_function_class is None:
+        from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+
+        class QuantizedSentenceTransformerEmbeddingFunction(SentenceTransformerEmbeddingFunction):
+            models: Dict[str, Any] = {}
+
+        _quantized_embedding_function_class = QuantizedSentenceTransformerEmbeddingFunction
+    # Same model, 2-4x faster encoding on CPU; requires sentence-transformers[onnx]
+    return _quantized_embedding_function_class(
+        model_name="all-MiniLM-L6-v2",
+        backend="onnx",
+        model_kwargs={"file_name": QUANTIZED_ONNX_FILE}
+    )
+
 class ChromaStateManager:
-    def __init__(self, persist_directory: str, embedding_function=None):
+    def __init__(self, persist_directory: str, embedding_function=None, quantized_embeddings: bool = False):
+        import chromadb
+        from chromadb.utils import embedding_functions
+
         self.client = chromadb.PersistentClient(path=persist_directory)
         if embedding_function is None:
-            embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+            if quantized_embeddings:
+                embedding_function = _quantized_embedding_function()
+            else:
+                embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
         self.embedding_function = embedding_function
         self.collection = self.client.get_or_create_collection(
             name="state_machines",
-            embedding_function=self.embedding_function
+            embedding_function=self.embedding_function,
+            metadata=HNSW_METADATA
         )
+        self._space = _collection_space(self.collection)
+        # Prompt JSON keyed by digest; never searched, so it is stored without real embeddings
+        self.prompt_collection = self.client.get_or_create_collection(
+            name=PROMPT_COLLECTION_NAME,
+            embedding_function=None
+        )
+
+    def _state_document(self, state: State) -> str:
+        return f"{state.name}: {_json_dumps(state.data.data)}"
 
     def save_state_machine(self, state_machine: StateMachine) -> None:
         documents = []
@@ -345,37 +843,68 @@ class ChromaStateManager:
         ids = []
 
         for state in state_machine.states.values():
-            state_text = f"{state.name}: {json.dumps(state.data.data)}"
-            documents.append(state_text)
+            documents.append(self._state_document(state))
             metadatas.append({
                 "type": "state_data",
                 "state_machine_id": state_machine.id,
                 "state_name": state.name,
-                "state_data": json.dumps(state.data.to_dict())
+                "state_data": _json_dumps(state.data.to_dict())
             })
             ids.append(state.id)
 
+        # Store the structure alongside the states so a single upsert embeds everything
+        state_machine_data = state_machine.to_dict()
+        documents.append(_json_dumps(state_machine_data))
+        metadatas.append({"type": "state_machine_structure"})
+        ids.append(state_machine.id)
+
         self.collection.upsert(
             documents=documents,
             metadatas=metadatas,
             ids=ids
         )
+        self._save_prompts(state_machine)
+
+    def _save_prompts(self, state_machine: StateMachine) -> None:
+        prompts: Dict[str, str] = {}
+        pending = [state_machine]
+        while pending:
+            machine = pending.pop()
+            prompts.update(machine._referenced_prompts())
+            pending.extend(machine.children.values())
+        if not prompts:
+            return
 
-        state_machine_data = state_machine.to_dict()
-        self.collection.upsert(
-            documents=[json.dumps(state_machine_data)],
-            metadatas=[{"type": "state_machine_structure"}],
-            ids=[state_machine.id]
-        )
+        # Blobs are content-addressed, so only digests the store does not have yet are written
+        stored = set(self.prompt_collection.get(ids=list(prompts), include=[])['ids'])
+        missing = [ref for ref in prompts if ref not in stored]
+        if missing:
+            self.prompt_collection.upsert(
+                ids=missing,
+                documents=[prompts[ref] for ref in missing],
+                embeddings=[PROMPT_PLACEHOLDER_EMBEDDING] * len(missing)
+            )
 
-    def load_state_machine(self, state_machine_id: str, model_client: Any) -> Optional[StateMachine]:
+    def _load_prompts(self, state_machine: StateMachine) -> None:
+        pending = [state_machine]
+        while pending:
+            machine = pending.pop()
+            refs = [ref for ref in machine._prompt_refcounts if ref not in machine._prompt_blobs]
+            if refs:
+                results = self.prompt_collection.get(ids=refs, include=["documents"])
+                machine._prompt_blobs.update(zip(results['ids'], results['documents']))
+            pending.extend(machine.children.values())
+
+    def load_state_machine(self, state_machine_id: str, model_client: Any = None) -> Optional[StateMachine]:
         try:
             results = self.collection.get(
                 where={"type": "state_machine_structure"},
                 ids=[state_machine_id]
             )
             if results['documents']:
-                return StateMachine.from_dict(json.loads(results['documents'][0]), model_client=model_client)
+                state_machine = StateMachine.from_dict(orjson.loads(results['documents'][0]), model_client=model_client)
+                self._load_prompts(state_machine)
+                return state_machine
         except Exception as e:
             print(f"Error loading state machine: {e}")
         return None
@@ -389,99 +918,313 @@ class ChromaStateManager:
 
         similar_states = []
         for i, (id, distance, metadata) in enumerate(zip(results['ids'][0], results['distances'][0], results['metadatas'][0])):
-            similarity = 1 - distance  # Adjust based on ChromaDB's metric
+            similarity = _distance_to_similarity(distance, self._space)
             similar_states.append({
                 'state_id': id,
                 'state_machine_id': metadata['state_machine_id'],
                 'state_name': metadata['state_name'],
                 'similarity': similarity,
-                'state_data': json.loads(metadata['state_data'])
+                'state_data': orjson.loads(metadata['state_data'])
             })
 
         return similar_states
 
-# Example usage
-if __name__ == "__main__":
-    # Load API key from environment variable
-    # Define initial state
-    # Load API key from environment variable
-    load_dotenv()
-
-    # Define states
-    welcome_state = State(
-        id=str(uuid.uuid4()),
-        name='Welcome',
-        data=StateData(data={'message': 'Welcome to E-Shop! How can I assist you today?'})
-    )
+class ResponseCache:
+    """Semantic cache of LLM transition decisions stored in a Chroma collection.
+
+    Entries are keyed by the embedding of ``"<state name>|<user input>"`` and hold the
+    resulting next state, assistant response and tool call, so a sufficiently
+    similar input in the same state can skip the model calls entirely.
+    """
+
+    def __init__(
+        self,
+        state_manager: 'ChromaStateManager',
+        similarity_threshold: float = 0.95,
+        max_entries: int = 1000,
+        collection_name: str = "llm_response_cache"
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.collection = state_manager.client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=state_manager.embedding_function,
+            metadata=HNSW_METADATA
+        )
+        self._space = _collection_space(self.collection)
 
-    main_menu_state = State(
-        id=str(uuid.uuid4()),
-        name='MainMenu',
-        data=StateData(data={'message': 'Please choose an option: Order Tracking, Returns and Refunds, Product Inquiry, Account Management, or type "exit" to quit.'})
-    )
+        # Entry ids in least- to most-recently used order, seeded from persisted entries
+        self._entries: 'OrderedDict[str, None]' = OrderedDict()
+        existing = self.collection.get(include=["metadatas"])
+        persisted = sorted(zip(existing['ids'], existing['metadatas']), key=lambda item: item[1].get('seq', 0))
+        for entry_id, _ in persisted:
+            self._entries[entry_id] = None
+        self._seq = max((metadata.get('seq', 0) for _, metadata in persisted), default=0)
 
-    order_tracking_state = State(
-        id=str(uuid.uuid4()),
-        name='OrderTracking',
-        data=StateData(data={'task': 'Assisting with order tracking...'})
-    )
+    @staticmethod
+    def _key(state_name: str, user_input: str) -> str:
+        return f"{state_name}|{user_input}"
 
-    collect_order_number_state = State(
-        id=str(uuid.uuid4()),
-        name='CollectOrderNumber',
-        data=StateData(data={'message': 'Please provide your order number.'})
-    )
+    @staticmethod
+    def _entry_id(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
-    provide_order_status_state = State(
-        id=str(uuid.uuid4()),
-        name='ProvideOrderStatus',
-        data=StateData(data={'task': 'Providing order status...'})
-    )
+    def lookup(self, state_name: str, user_input: str) -> Optional[Dict[str, Any]]:
+        if not self._entries:
+            return None
 
-    returns_refunds_state = State(
-        id=str(uuid.uuid4()),
-        name='ReturnsAndRefunds',
-        data=StateData(data={'task': 'Assisting with returns and refunds...'})
-    )
+        results = self.collection.query(
+            query_texts=[self._key(state_name, user_input)],
+            n_results=1,
+            where={"state_name": state_name}
+        )
+        if not results['ids'] or not results['ids'][0]:
+            return None
 
-    product_inquiry_state = State(
-        id=str(uuid.uuid4()),
-        name='ProductInquiry',
-        data=StateData(data={'task': 'Answering product inquiries...'})
-    )
+        similarity = _distance_to_similarity(results['distances'][0][0], self._space)
+        if similarity < self.similarity_threshold:
+            return None
 
-    account_management_state = State(
-        id=str(uuid.uuid4()),
-        name='AccountManagement',
-        data=StateData(data={'task': 'Assisting with account management...'})
-    )
+        entry_id = results['ids'][0][0]
+        metadata = results['metadatas'][0][0]
+        with self.lock:
+            if entry_id in self._entries:
+                self._entries.move_to_end(entry_id)
 
-    goodbye_state = State(
-        id=str(uuid.uuid4()),
-        name='Goodbye',
-        data=StateData(data={'message': 'Thank you for visiting E-Shop! Have a great day!'})
-    )
+        return {
+            "next_state": metadata["next_state"],
+            "assistant_response": metadata["assistant_response"],
+            "tool_call": orjson.loads(metadata["tool_call_json"]),
+            "similarity": similarity
+        }
+
+    def store(
+        self,
+        state_name: str,
+        user_input: str,
+        next_state: str,
+        assistant_response: str,
+        tool_call: Dict[str, Any]
+    ) -> None:
+        key = self._key(state_name, user_input)
+        entry_id = self._entry_id(key)
+
+        with self.lock:
+            self._seq += 1
+            self.collection.upsert(
+                documents=[key],
+                metadatas=[{
+                    "state_name": state_name,
+                    "next_state": next_state,
+                    "assistant_response": assistant_response,
+                    "tool_call_json": _json_dumps(tool_call),
+                    "seq": self._seq
+                }],
+                ids=[entry_id]
+            )
+            self._entries[entry_id] = None
+            self._entries.move_to_end(entry_id)
+
+            # Evict least recently used entries once over capacity
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            if evicted:
+                self.collection.delete(ids=evicted)
+
+# Limits for one embeddings request when warming a SemanticCache
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_BATCH_TOKENS = 250_000
+
+class SemanticCache:
+    """In-process semantic cache of LLM transition decisions held in a numpy matrix.
+
+    Offers the same ``lookup``/``store`` interface as ``ResponseCache`` without a
+    Chroma collection: user inputs are embedded with the OpenAI embeddings API,
+    kept as unit-length rows, and compared by cosine similarity (a single matrix
+    product) against earlier inputs seen in the same state.
+    """
+
+    def __init__(
+        self,
+        client: Any = None,
+        embedding_model: str = "text-embedding-3-small",
+        similarity_threshold: float = 0.92,
+        max_entries: int = 1000
+    ):
+        if max_entries < 1:
+            raise ValueError(f"max_entries must be at least 1, got {max_entries}")
+        self.client = client  # Falls back to get_default_client() when None
+        self.embedding_model = embedding_model
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._embeddings = None  # (capacity, dim) float32 matrix, allocated on first store
+        self._keys: List[Tuple[str, str]] = []  # (state name, user input) of each row
+        self._entries: List[Dict[str, Any]] = []
+        self._last_used: List[int] = []
+        self._rows_by_state: Dict[str, List[int]] = defaultdict(list)
+        self._row_by_key: Dict[Tuple[str, str], int] = {}
+        self._seq = 0
+        # lookup() and the store() after a miss embed the same input; reuse that vector
+        self._last_embedded: Optional[Tuple[str, Any]] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _embed(self, text: str):
+        import numpy as np
+
+        last = self._last_embedded
+        if last is not None and last[0] == text:
+            return last[1]
+        client = self.client if self.client is not None else get_default_client()
+        response = client.embeddings.create(model=self.embedding_model, input=[text])
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm:
+            embedding /= norm
+        self._last_embedded = (text, embedding)
+        return embedding
+
+    def lookup(self, state_name: str, user_input: str) -> Optional[Dict[str, Any]]:
+        if not self._rows_by_state.get(state_name):
+            return None
+
+        embedding = self._embed(user_input)
+        with self.lock:
+            rows = self._rows_by_state.get(state_name)
+            if not rows:
+                return None
+            similarities = self._embeddings[rows] @ embedding
+            best = int(similarities.argmax())
+            similarity = float(similarities[best])
+            if similarity < self.similarity_threshold:
+                return None
+            row = rows[best]
+            self._seq += 1
+            self._last_used[row] = self._seq
+            entry = self._entries[row]
+
+        return dict(entry, similarity=similarity)
+
+    def store(
+        self,
+        state_name: str,
+        user_input: str,
+        next_state: str,
+        assistant_response: str,
+        tool_call: Dict[str, Any]
+    ) -> None:
+        embedding = self._embed(user_input)
+        with self.lock:
+            self._insert(state_name, user_input, next_state, assistant_response, tool_call, embedding)
+
+    def warm(self, entries: Iterable[Dict[str, Any]]) -> None:
+        """Store many decisions at once, embedding their inputs in batched requests.
+
+        Each entry takes the keyword arguments of ``store``. Inputs are sent in
+        chunks of at most ``EMBEDDING_BATCH_SIZE`` inputs and roughly
+        ``EMBEDDING_BATCH_TOKENS`` tokens per embeddings call.
+        """
+        import numpy as np
+
+        entries = list(entries)
+        client = self.client if self.client is not None else get_default_client()
+        start = 0
+        while start < len(entries):
+            end, tokens = start, 0
+            while end < len(entries) and end - start < EMBEDDING_BATCH_SIZE:
+                tokens += len(entries[end]["user_input"]) // 4 + 1  # ~4 characters per token
+                if tokens > EMBEDDING_BATCH_TOKENS and end > start:
+                    break
+                end += 1
+            chunk = entries[start:end]
+            response = client.embeddings.create(
+                model=self.embedding_model,
+                input=[entry["user_input"] for entry in chunk]
+            )
+            embeddings = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            embeddings /= norms
+            with self.lock:
+                for entry, embedding in zip(chunk, embeddings):
+                    self._insert(embedding=embedding, **entry)
+            start = end
+
+    def _insert(
+        self,
+        state_name: str,
+        user_input: str,
+        next_state: str,
+        assistant_response: str,
+        tool_call: Dict[str, Any],
+        embedding: Any
+    ) -> None:
+        # Caller holds self.lock
+        import numpy as np
+
+        key = (state_name, user_input)
+        entry = {
+            "next_state": next_state,
+            "assistant_response": assistant_response,
+            "tool_call": dict(tool_call)
+        }
+        self._seq += 1
+        row = self._row_by_key.get(key)
+        if row is None:
+            if len(self._entries) < self.max_entries:
+                row = len(self._entries)
+                if self._embeddings is None:
+                    self._embeddings = np.empty((min(16, self.max_entries), embedding.shape[0]), dtype=np.float32)
+                elif row == len(self._embeddings):
+                    grown = np.empty((min(2 * row, self.max_entries), embedding.shape[0]), dtype=np.float32)
+                    grown[:row] = self._embeddings
+                    self._embeddings = grown
+                self._keys.append(key)
+                self._entries.append(entry)
+                self._last_used.append(self._seq)
+            else:
+                # Over capacity: the least recently used row is overwritten
+                row = min(range(len(self._last_used)), key=self._last_used.__getitem__)
+                evicted_key = self._keys[row]
+                self._rows_by_state[evicted_key[0]].remove(row)
+                del self._row_by_key[evicted_key]
+                self._keys[row] = key
+            self._rows_by_state[state_name].append(row)
+            self._row_by_key[key] = row
+
+        self._embeddings[row] = embedding
+        self._entries[row] = entry
+        self._last_used[row] = self._seq
+
+# Example usage
+if __name__ == "__main__":
+    # Minimal demo; examples/example.py (also started by run.py) is the full customer support assistant
+    # Define states as (name, data) pairs
+    STATES = [
+        ('Welcome', {'message': 'Welcome to E-Shop! How can I assist you today?'}),
+        ('MainMenu', {'message': 'Please choose an option: Order Tracking, Returns and Refunds, Product Inquiry, Account Management, or type "exit" to quit.'}),
+        ('OrderTracking', {'task': 'Assisting with order tracking...'}),
+        ('CollectOrderNumber', {'message': 'Please provide your order number.'}),
+        ('ProvideOrderStatus', {'task': 'Providing order status...'}),
+        ('Goodbye', {'message': 'Thank you for visiting E-Shop! Have a great day!'}),
+    ]
+    states = {name: State(id=str(uuid.uuid4()), name=name, data=StateData(data=data)) for name, data in STATES}
 
     # Create the state machine with a specified model client
-    openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    openai_client = get_default_client()
     state_machine = StateMachine(
         name='CustomerSupportAssistant',
-        initial_state=welcome_state,
+        initial_state=states['Welcome'],
         model_client=openai_client,
         model_name='gpt-4o'  # or any model you prefer
     )
+    state_machine.add_states(states.values())
 
-
-    state_machine.add_state(main_menu_state)
-    state_machine.add_state(order_tracking_state)
-    state_machine.add_state(collect_order_number_state)
-    state_machine.add_state(provide_order_status_state)
-    state_machine.add_state(returns_refunds_state)
-    state_machine.add_state(product_inquiry_state)
-    state_machine.add_state(account_management_state)
-    state_machine.add_state(goodbye_state)
-
-        # Condition function to check if the user input requests order tracking
+    # Condition function to check if the user input requests order tracking
     def is_order_tracking(user_input: str, state_machine: StateMachine) -> bool:
         return 'track' in user_input.lower() or 'order' in user_input.lower()
 
@@ -493,90 +1236,43 @@ if __name__ == "__main__":
     def is_exit_command(user_input: str, state_machine: StateMachine) -> bool:
         return user_input.lower() in ['exit', 'quit', 'goodbye']
 
-    # Define transitions with conditions
-    transitions = [
-        Transition(from_state='Welcome', to_state='MainMenu'),
-        Transition(from_state='MainMenu', to_state='OrderTracking', condition=is_order_tracking),
-        Transition(from_state='OrderTracking', to_state='CollectOrderNumber'),
-        Transition(from_state='CollectOrderNumber', to_state='ProvideOrderStatus', condition=has_order_number),
-        Transition(from_state='ProvideOrderStatus', to_state='MainMenu'),
-        Transition(from_state='MainMenu', to_state='Goodbye', condition=is_exit_command),
-        # ... other transitions ...
+    # Define transitions as (from_state, to_state, condition) triples
+    TRANSITIONS = [
+        ('Welcome', 'MainMenu', None),
+        ('MainMenu', 'OrderTracking', is_order_tracking),
+        ('OrderTracking', 'CollectOrderNumber', None),
+        ('CollectOrderNumber', 'ProvideOrderStatus', has_order_number),
+        ('ProvideOrderStatus', 'MainMenu', None),
+        ('MainMenu', 'Goodbye', is_exit_command),
     ]
-
-    # Add transitions to the state machine
-    for transition in transitions:
-        state_machine.add_transition(transition)
-
-    # Implement action functions
-    def fetch_order_status(order_number: str) -> str:
-        # Simulate fetching order status from a database
-        return f"Order {order_number} is currently in transit and will be delivered in 2 days."
-
-    def handle_returns_and_refunds():
-        return "I've initiated the return process for you. Please check your email for further instructions."
-
-    def answer_product_inquiry():
-        return "The product you asked about is in stock and available in various sizes."
-
-    def assist_account_management():
-        return "I've updated your account preferences as requested."
+    state_machine.add_transitions(
+        Transition(from_state=from_state, to_state=to_state, condition=condition)
+        for from_state, to_state, condition in TRANSITIONS
+    )
 
     def main():
         print(f"Current State: {state_machine.current_state.name}")
         print(state_machine.current_state.data.data['message'])
-        # state_machine.state_history.append(state_machine.current_state.name)
 
         while True:
             user_input = input("You: ")
-
             if not user_input.strip():
                 continue  # Skip empty input
 
-            # Before triggering transition, print current state
-            print(f"\n[Before Transition] Current State: {state_machine.current_state.name}")
-
             # Exit the loop if the user wants to quit
-            if user_input.lower() in ['exit', 'quit', 'goodbye']:
-                state_machine.current_state = goodbye_state
+            if is_exit_command(user_input, state_machine):
+                state_machine.current_state = states['Goodbye']
                 print(state_machine.current_state.data.data['message'])
                 break
 
             state_machine.trigger_transition(user_input)
-
-            # After triggering transition, print new state
             print(f"[After Transition] Current State: {state_machine.current_state.name}")
 
-            # Update state history
-            state_machine.state_history.append(state_machine.current_state.name)
-            print(f"State History: {' -> '.join(state_machine.state_history)}")
-
             # After the transition, print the assistant's response
-            if state_machine.conversation_history:
-                last_turn = state_machine.conversation_history[-1]
-                assistant_response = last_turn.get('assistant_response', '')
-                if assistant_response:
-                    print(f"Assistant: {assistant_response}")
-
-            # Perform any actions associated with the current state
-            if state_machine.current_state.name == 'ProvideOrderStatus':
-                # Assume we stored the order_number in metadata
-                order_number = state_machine.current_state.data.metadata.custom_data.get('order_number', 'Unknown')
-                status_message = fetch_order_status(order_number)
-                print(f"Action: {status_message}")
-            elif state_machine.current_state.name == 'ReturnsAndRefunds':
-                result_message = handle_returns_and_refunds()
-                print(f"Action: {result_message}")
-            elif state_machine.current_state.name == 'ProductInquiry':
-                result_message = answer_product_inquiry()
-                print(f"Action: {result_message}")
-            elif state_machine.current_state.name == 'AccountManagement':
-                result_message = assist_account_management()
-                print(f"Action: {result_message}")
-            elif state_machine.current_state.name == 'Goodbye':
-                print(state_machine.current_state.data.data['message'])
-                break
+            history = state_machine.conversation_history
+            assistant_response = history[-1].get('assistant_response', '') if history else ''
+            if assistant_response:
+                print(f"Assistant: {assistant_response}")
 
-        # Optionally, after exiting, print the final state history
         print("\nFinal State History:")
         print(" -> ".join(state_machine.state_history))
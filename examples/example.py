@@ -1,12 +1,10 @@
-import os
+import asyncio
+import re
+import sys
 import uuid
+from functools import lru_cache
 from dotenv import load_dotenv
 from typing import Any, Dict
-import openai
-from openai import OpenAI
-import os
-
-api_key = os.getenv('OPENAI_API_KEY')
 
 from ai_agent_state.state import (
     Metadata,
@@ -16,9 +14,6 @@ from ai_agent_state.state import (
     StateMachine,
 )
 
-# Load environment variables (e.g., OpenAI API key)
-load_dotenv()
-
 # Factory functions to simplify state and transition creation
 def create_state(name: str, data: Dict[str, Any]) -> State:
     return State(
@@ -30,103 +25,90 @@ def create_state(name: str, data: Dict[str, Any]) -> State:
 def create_transition(from_state: str, to_state: str, condition=None) -> Transition:
     return Transition(from_state=from_state, to_state=to_state, condition=condition)
 
+# Keywords that signal each intent
+INTENT_MAP = {
+    'track': 'OrderTracking',
+    'order': 'OrderTracking',
+    'return': 'ReturnsAndRefunds',
+    'refund': 'ReturnsAndRefunds',
+    'product': 'ProductInquiry',
+    'inquiry': 'ProductInquiry',
+    'question': 'ProductInquiry',
+    'account': 'AccountManagement',
+    'profile': 'AccountManagement',
+}
+INTENT_PATTERN = re.compile('|'.join(INTENT_MAP), re.IGNORECASE)
+_DIGIT_RE = re.compile(r'\d')
+_DIGITS_RE = re.compile(r'\d+')
+EXIT_COMMANDS = frozenset({'exit', 'quit', 'goodbye'})
+
+@lru_cache(maxsize=128)
+def detect_intents(user_input: str) -> frozenset:
+    # One regex pass finds every intent; the conditions below share the cached result
+    return frozenset(INTENT_MAP[keyword.lower()] for keyword in INTENT_PATTERN.findall(user_input))
+
 # Define condition functions
 def is_order_tracking(user_input: str, state_machine: StateMachine) -> bool:
-    return 'track' in user_input.lower() or 'order' in user_input.lower()
+    return 'OrderTracking' in detect_intents(user_input)
 
 def is_returns_and_refunds(user_input: str, state_machine: StateMachine) -> bool:
-    return 'return' in user_input.lower() or 'refund' in user_input.lower()
+    return 'ReturnsAndRefunds' in detect_intents(user_input)
 
 def is_product_inquiry(user_input: str, state_machine: StateMachine) -> bool:
-    return 'product' in user_input.lower() or 'inquiry' in user_input.lower() or 'question' in user_input.lower()
+    return 'ProductInquiry' in detect_intents(user_input)
 
 def is_account_management(user_input: str, state_machine: StateMachine) -> bool:
-    return 'account' in user_input.lower() or 'profile' in user_input.lower()
+    return 'AccountManagement' in detect_intents(user_input)
 
 def has_order_number(user_input: str, state_machine: StateMachine) -> bool:
-    return any(char.isdigit() for char in user_input)
+    return _DIGIT_RE.search(user_input) is not None
 
 def is_exit_command(user_input: str, state_machine: StateMachine) -> bool:
-    return user_input.lower() in ['exit', 'quit', 'goodbye']
-
-# Define states
-welcome_state = create_state('Welcome', {
-    'message': 'Welcome to E-Shop! How can I assist you today?'
-})
-
-main_menu_state = create_state('MainMenu', {
-    'message': 'Please choose an option: Order Tracking, Returns and Refunds, Product Inquiry, Account Management, or type "exit" to quit.'
-})
-
-order_tracking_state = create_state('OrderTracking', {
-    'message': 'Sure, I can help with order tracking.'
-})
-
-collect_order_number_state = create_state('CollectOrderNumber', {
-    'message': 'Please provide your order number.'
-})
-
-provide_order_status_state = create_state('ProvideOrderStatus', {
-    'task': 'Providing order status...'
-})
-
-returns_refunds_state = create_state('ReturnsAndRefunds', {
-    'message': 'I can assist you with returns and refunds.'
-})
-
-product_inquiry_state = create_state('ProductInquiry', {
-    'message': 'I can help answer your product questions.'
-})
+    return user_input.lower() in EXIT_COMMANDS
+
+# Define states as (name, data) pairs
+STATES = [
+    ('Welcome', {'message': 'Welcome to E-Shop! How can I assist you today?'}),
+    ('MainMenu', {'message': 'Please choose an option: Order Tracking, Returns and Refunds, Product Inquiry, Account Management, or type "exit" to quit.'}),
+    ('OrderTracking', {'message': 'Sure, I can help with order tracking.'}),
+    ('CollectOrderNumber', {'message': 'Please provide your order number.'}),
+    ('ProvideOrderStatus', {'task': 'Providing order status...'}),
+    ('ReturnsAndRefunds', {'message': 'I can assist you with returns and refunds.'}),
+    ('ProductInquiry', {'message': 'I can help answer your product questions.'}),
+    ('AccountManagement', {'message': 'I can assist you with managing your account.'}),
+    ('Goodbye', {'message': 'Thank you for visiting E-Shop! Have a great day!'}),
+]
 
-account_management_state = create_state('AccountManagement', {
-    'message': 'I can assist you with managing your account.'
-})
+# Define transitions as (from_state, to_state, condition) triples
+TRANSITIONS = [
+    ('Welcome', 'MainMenu', None),
+    ('MainMenu', 'OrderTracking', is_order_tracking),
+    ('OrderTracking', 'CollectOrderNumber', None),
+    ('CollectOrderNumber', 'ProvideOrderStatus', has_order_number),
+    ('ProvideOrderStatus', 'MainMenu', None),
+    ('MainMenu', 'ReturnsAndRefunds', is_returns_and_refunds),
+    ('MainMenu', 'ProductInquiry', is_product_inquiry),
+    ('MainMenu', 'AccountManagement', is_account_management),
+    ('MainMenu', 'Goodbye', is_exit_command),
+    ('ReturnsAndRefunds', 'MainMenu', None),
+    ('ProductInquiry', 'MainMenu', None),
+    ('AccountManagement', 'MainMenu', None),
+]
 
-goodbye_state = create_state('Goodbye', {
-    'message': 'Thank you for visiting E-Shop! Have a great day!'
-})
+states = {name: create_state(name, data) for name, data in STATES}
 
-# Create the state machine with a specified model client
-# Assume `model_client` is passed or created elsewhere in your application
-model_client = openai.OpenAI(api_key=api_key)
+# Create the state machine; atrigger_transition falls back to the pooled
+# get_default_async_client() since no model client is passed
 state_machine = StateMachine(
     name='CustomerSupportAssistant',
-    initial_state=welcome_state,
-    model_client=model_client,  # Pass the model client here
+    initial_state=states['Welcome'],
     model_name='gpt-4o'  # Optional: specify a model name if needed
 )
-
-# Add states to the state machine
-state_machine.add_state(main_menu_state)
-state_machine.add_state(order_tracking_state)
-state_machine.add_state(collect_order_number_state)
-state_machine.add_state(provide_order_status_state)
-state_machine.add_state(returns_refunds_state)
-state_machine.add_state(product_inquiry_state)
-state_machine.add_state(account_management_state)
-state_machine.add_state(goodbye_state)
-
-# Define transitions with condition functions
-transitions = [
-    create_transition('Welcome', 'MainMenu'),
-    create_transition('MainMenu', 'OrderTracking', condition=is_order_tracking),
-    create_transition('OrderTracking', 'CollectOrderNumber'),
-    create_transition('CollectOrderNumber', 'ProvideOrderStatus', condition=has_order_number),
-    create_transition('ProvideOrderStatus', 'MainMenu'),
-    create_transition('MainMenu', 'ReturnsAndRefunds', condition=is_returns_and_refunds),
-    create_transition('MainMenu', 'ProductInquiry', condition=is_product_inquiry),
-    create_transition('MainMenu', 'AccountManagement', condition=is_account_management),
-    create_transition('MainMenu', 'Goodbye', condition=is_exit_command),
-    create_transition('ReturnsAndRefunds', 'MainMenu'),
-    create_transition('ProductInquiry', 'MainMenu'),
-    create_transition('AccountManagement', 'MainMenu'),
-]
-
-# Add transitions to the state machine
-for transition in transitions:
-    state_machine.add_transition(transition)
+state_machine.add_states(states.values())
+state_machine.add_transitions(create_transition(*transition) for transition in TRANSITIONS)
 
 # Implement action functions
+@lru_cache(maxsize=1024)  # Repeat lookups for the same order skip the backend round trip
 def fetch_order_status(order_number: str) -> str:
     # Simulate fetching order status from a database
     return f"Order {order_number} is currently in transit and will be delivered in 2 days."
@@ -140,13 +122,53 @@ def answer_product_inquiry():
 def assist_account_management():
     return "I've updated your account preferences as requested."
 
-def main():
-    print(f"Current State: {state_machine.current_state.name}")
+# Handlers for the actions associated with each state
+def show_state_message(state_machine: StateMachine, user_input: str) -> None:
     print(state_machine.current_state.data.data['message'])
 
-    while True:
-        user_input = input("You: ")
+def provide_order_status(state_machine: StateMachine, user_input: str) -> None:
+    # Extract order number from user input, falling back to the one stored in metadata
+    order_number = (
+        ''.join(_DIGITS_RE.findall(user_input))
+        or state_machine.current_state.data.metadata.custom_data.get('order_number', 'Unknown')
+    )
+    print(f"Action: {fetch_order_status(order_number)}")
+
+def returns_and_refunds_action(state_machine: StateMachine, user_input: str) -> None:
+    print(f"Action: {handle_returns_and_refunds()}")
+
+def product_inquiry_action(state_machine: StateMachine, user_input: str) -> None:
+    print(f"Action: {answer_product_inquiry()}")
+
+def account_management_action(state_machine: StateMachine, user_input: str) -> None:
+    print(f"Action: {assist_account_management()}")
+
+ACTION_HANDLERS = {
+    'OrderTracking': show_state_message,
+    'CollectOrderNumber': show_state_message,
+    'ProvideOrderStatus': provide_order_status,
+    'ReturnsAndRefunds': returns_and_refunds_action,
+    'ProductInquiry': product_inquiry_action,
+    'AccountManagement': account_management_action,
+}
+
+def read_user_inputs(prompt: str = "You: "):
+    # Piped or replayed input is read line by line through the buffered stdin;
+    # interactive sessions keep using input()
+    if sys.stdin.isatty():
+        while True:
+            yield input(prompt)
+    for line in sys.stdin:
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        yield line.rstrip('\n')
+
+async def main():
+    load_dotenv()  # Load environment variables (e.g., OpenAI API key)
+    print(f"Current State: {state_machine.current_state.name}")
+    print(state_machine.current_state.data.data['message'])
 
+    for user_input in read_user_inputs():
         if not user_input.strip():
             continue  # Skip empty input
 
@@ -156,47 +178,34 @@ def main():
         # Check if the user wants to exit
         if is_exit_command(user_input, state_machine):
             # Transition to 'Goodbye' state
-            state_machine.current_state = goodbye_state
+            state_machine.current_state = states['Goodbye']
             state_machine.state_history.append(state_machine.current_state.name)
             print(state_machine.current_state.data.data['message'])
             break
 
-        state_machine.trigger_transition(user_input)
+        await state_machine.atrigger_transition(user_input)
+
+        # Look the new state up once for the rest of the turn
+        cur = state_machine.current_state
+        cur_name = cur.name
+        cur_msg = cur.data.data.get('message')
 
         # After triggering transition, print new state
-        print(f"[After Transition] Current State: {state_machine.current_state.name}")
-        print(f"State History: {' -> '.join(state_machine.state_history)}")
+        print(f"[After Transition] Current State: {cur_name}")
+        print(f"State History: ... -> {cur_name}")  # Full history is printed on exit
 
         # Perform any actions associated with the current state
-        if state_machine.current_state.name == 'OrderTracking':
-            print(state_machine.current_state.data.data['message'])
-        elif state_machine.current_state.name == 'CollectOrderNumber':
-            print(state_machine.current_state.data.data['message'])
-        elif state_machine.current_state.name == 'ProvideOrderStatus':
-            # Extract order number from user input or previous input
-            order_number = ''.join(filter(str.isdigit, user_input))
-            if not order_number:
-                # Attempt to retrieve from metadata
-                order_number = state_machine.current_state.data.metadata.custom_data.get('order_number', 'Unknown')
-            status_message = fetch_order_status(order_number)
-            print(f"Action: {status_message}")
-        elif state_machine.current_state.name == 'ReturnsAndRefunds':
-            result_message = handle_returns_and_refunds()
-            print(f"Action: {result_message}")
-        elif state_machine.current_state.name == 'ProductInquiry':
-            result_message = answer_product_inquiry()
-            print(f"Action: {result_message}")
-        elif state_machine.current_state.name == 'AccountManagement':
-            result_message = assist_account_management()
-            print(f"Action: {result_message}")
+        handler = ACTION_HANDLERS.get(cur_name)
+        if handler:
+            handler(state_machine, user_input)
 
         # Provide the assistant's response if there is a message
-        if 'message' in state_machine.current_state.data.data:
-            print(f"Assistant: {state_machine.current_state.data.data['message']}")
+        if cur_msg is not None:
+            print(f"Assistant: {cur_msg}")
 
     # Optionally, after exiting, print the final state history
     print("\nFinal State History:")
     print(" -> ".join(state_machine.state_history))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -29,6 +29,7 @@ setup(
         "chromadb",
         "openai",
         "python-dotenv",
+        "orjson",
         "numpy",
         "pandas",
         "tqdm",
@@ -43,5 +44,8 @@ setup(
         "viz": [
             "graphviz",
         ],
+        "onnx": [
+            "sentence-transformers[onnx]",
+        ],
     },
 )
\ No newline at end of file
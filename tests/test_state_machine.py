@@ -1,5 +1,11 @@
+import asyncio
+import gc
+import time
 import unittest
+import httpx
 import uuid
+from contextlib import ExitStack
+from dataclasses import FrozenInstanceError, fields
 from datetime import datetime
 from ai_agent_state.state import (
     Metadata,
@@ -8,9 +14,13 @@ from ai_agent_state.state import (
     Transition,
     StateMachine,
     SetNextState,
-    ChromaStateManager
+    ChromaStateManager,
+    ResponseCache,
+    SemanticCache,
+    get_default_client,
+    get_default_async_client
 ) 
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 from unittest.mock import patch
 import json
 
@@ -26,12 +36,25 @@ class TestMetadata(unittest.TestCase):
         self.assertIn('created_at', metadata_dict)
         self.assertIn('updated_at', metadata_dict)
 
+    def test_metadata_to_dict_covers_all_fields(self):
+        metadata = Metadata(custom_data={'key': 'value'})
+        metadata_dict = metadata.to_dict()
+        self.assertEqual(set(metadata_dict), {f.name for f in fields(Metadata)})
+        metadata_dict['custom_data']['key'] = 'changed'
+        self.assertEqual(metadata.custom_data, {'key': 'value'})
+
     def test_metadata_from_dict(self):
         metadata = Metadata()
         metadata_dict = metadata.to_dict()
         new_metadata = Metadata.from_dict(metadata_dict)
         self.assertEqual(metadata.created_at, new_metadata.created_at) 
 
+    def test_metadata_timestamps_serialize_as_iso(self):
+        metadata = Metadata.from_dict({'created_at': '2024-05-01T12:30:45.123456', 'updated_at': '2024-05-01T12:30:45'})
+        self.assertIsInstance(metadata.created_at, int)
+        self.assertEqual(metadata.to_dict()['created_at'], '2024-05-01T12:30:45.123456')
+        self.assertEqual(metadata.to_dict()['updated_at'], '2024-05-01T12:30:45')
+
 class TestStateData(unittest.TestCase):
     def test_state_data_creation(self):
         state_data = StateData(data={'key': 'value'})
@@ -97,6 +120,11 @@ class TestTransition(unittest.TestCase):
         self.assertEqual(new_transition.condition, sample_condition)
         self.assertEqual(new_transition.action, sample_action) 
 
+    def test_transition_is_immutable(self):
+        transition = Transition(from_state='state1', to_state='state2')
+        with self.assertRaises(FrozenInstanceError):
+            transition.to_state = 'state3'
+
 class TestChromaStateManager(unittest.TestCase):
     def setUp(self):
         # Mock the ChromaDB client and collection
@@ -150,4 +178,656 @@ class TestChromaStateManager(unittest.TestCase):
         # Pass the mock_model_client to load_state_machine
         loaded_state_machine = self.chroma_manager.load_state_machine('1', model_client=mock_model_client)
         self.assertIsNotNone(loaded_state_machine)
-        self.assertEqual(loaded_state_machine.name, 'TestStateMachine') 
\ No newline at end of file
+        self.assertEqual(loaded_state_machine.name, 'TestStateMachine')
+
+class TestChromaStateManagerWrites(unittest.TestCase):
+    def setUp(self):
+        self.mock_collection = Mock()
+        self.mock_prompt_collection = Mock()
+        self.mock_prompt_collection.get.return_value = {'ids': [], 'documents': []}
+        self.mock_client = Mock()
+        self.mock_client.get_or_create_collection.side_effect = lambda name, **kwargs: (
+            self.mock_prompt_collection if name == 'prompt_blobs' else self.mock_collection
+        )
+
+        self.patcher = patch('chromadb.PersistentClient', return_value=self.mock_client)
+        self.patcher.start()
+
+        self.chroma_manager = ChromaStateManager(persist_directory='test_dir', embedding_function=Mock())
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_save_state_machine_single_upsert(self):
+        state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData(data={'key': 'value'})),
+            model_client=Mock()
+        )
+        state_machine.add_state(State(id='2', name='state2', data=StateData()))
+
+        self.chroma_manager.save_state_machine(state_machine)
+
+        self.mock_collection.upsert.assert_called_once()
+        _, kwargs = self.mock_collection.upsert.call_args
+        self.assertEqual(kwargs['ids'], ['1', '2', state_machine.id])
+        self.assertEqual(kwargs['metadatas'][-1], {'type': 'state_machine_structure'})
+        self.assertEqual(json.loads(kwargs['documents'][-1])['name'], 'TestStateMachine')
+        self.assertEqual(kwargs['documents'][:2], ['state1: {"key":"value"}', 'state2: {}'])
+        self.mock_prompt_collection.upsert.assert_not_called()
+
+    def _machine_with_prompt(self):
+        state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData()),
+            model_client=Mock()
+        )
+        ref = state_machine._store_prompt([{'role': 'user', 'content': 'hi'}])
+        state_machine.states['state1'].data.metadata.llm_prompt = ref
+        return state_machine, ref
+
+    def test_save_state_machine_writes_missing_prompts_by_reference(self):
+        state_machine, ref = self._machine_with_prompt()
+
+        self.chroma_manager.save_state_machine(state_machine)
+
+        _, kwargs = self.mock_collection.upsert.call_args
+        structure = json.loads(kwargs['documents'][-1])
+        self.assertNotIn('prompt_blobs', structure)
+        self.assertEqual(structure['states']['state1']['data']['metadata']['llm_prompt'], ref)
+        _, kwargs = self.mock_prompt_collection.upsert.call_args
+        self.assertEqual(kwargs['ids'], [ref])
+        self.assertEqual(kwargs['documents'], [state_machine.get_prompt(ref)])
+
+        self.mock_prompt_collection.upsert.reset_mock()
+        self.mock_prompt_collection.get.return_value = {'ids': [ref], 'documents': []}
+        self.chroma_manager.save_state_machine(state_machine)
+        self.mock_prompt_collection.upsert.assert_not_called()
+
+    def test_load_state_machine_restores_prompts(self):
+        state_machine, ref = self._machine_with_prompt()
+        prompt = state_machine.get_prompt(ref)
+        self.mock_collection.get.return_value = {'documents': [json.dumps(state_machine.to_dict())]}
+        self.mock_prompt_collection.get.return_value = {'ids': [ref], 'documents': [prompt]}
+
+        loaded = self.chroma_manager.load_state_machine(state_machine.id)
+
+        self.assertEqual(loaded.get_prompt(ref), prompt)
+        _, kwargs = self.mock_prompt_collection.get.call_args
+        self.assertEqual(kwargs['ids'], [ref])
+
+    def _isolated_model_caches(self):
+        # Embedding functions cache loaded models per process; start each test from empty caches
+        from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+
+        stack = ExitStack()
+        stack.enter_context(patch.dict(SentenceTransformerEmbeddingFunction.models, clear=True))
+        stack.enter_context(patch('ai_agent_state.state._quantized_embedding_function_class', None))
+        return stack
+
+    def test_quantized_embeddings_use_onnx_backend(self):
+        with self._isolated_model_caches(), patch('sentence_transformers.SentenceTransformer') as mock_model:
+            ChromaStateManager(persist_directory='test_dir', quantized_embeddings=True)
+        _, kwargs = mock_model.call_args
+        self.assertEqual(kwargs['backend'], 'onnx')
+        self.assertIn('qint8', kwargs['model_kwargs']['file_name'])
+
+    def test_quantized_embeddings_do_not_share_fp32_model(self):
+        def build_model(model_name_or_path, device, **kwargs):
+            return Mock(backend=kwargs.get('backend', 'torch'))
+
+        with self._isolated_model_caches(), patch('sentence_transformers.SentenceTransformer', side_effect=build_model):
+            fp32_manager = ChromaStateManager(persist_directory='test_dir')
+            quantized_manager = ChromaStateManager(persist_directory='test_dir', quantized_embeddings=True)
+
+        self.assertEqual(fp32_manager.embedding_function._model.backend, 'torch')
+        self.assertEqual(quantized_manager.embedding_function._model.backend, 'onnx')
+
+    def test_search_similar_states_converts_distance_for_collection_space(self):
+        self.mock_collection.query.return_value = {
+            'ids': [['1']],
+            'distances': [[0.5]],
+            'metadatas': [[{'state_machine_id': 'sm', 'state_name': 'state1', 'state_data': '{}'}]]
+        }
+
+        for space, similarity in (('cosine', 0.5), ('l2', 0.75)):
+            self.mock_collection.configuration = {'hnsw': {'space': space}, 'spann': None}
+            manager = ChromaStateManager(persist_directory='test_dir', embedding_function=Mock())
+            results = manager.search_similar_states('state')
+            self.assertEqual(results[0]['similarity'], similarity)
+
+    def test_collection_uses_cosine_hnsw_index(self):
+        _, kwargs = self.mock_client.get_or_create_collection.call_args_list[0]
+        self.assertEqual(kwargs['name'], 'state_machines')
+        self.assertEqual(kwargs['metadata']['hnsw:space'], 'cosine')
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.mock_collection = Mock()
+        self.mock_collection.get.return_value = {'ids': [], 'metadatas': []}
+        self.mock_manager = Mock()
+        self.mock_manager.client.get_or_create_collection.return_value = self.mock_collection
+        self.cache = ResponseCache(self.mock_manager, max_entries=2)
+
+    def _query_result(self, distance):
+        return {
+            'ids': [['entry']],
+            'distances': [[distance]],
+            'metadatas': [[{
+                'next_state': 'state2',
+                'assistant_response': 'Moving on.',
+                'tool_call_json': json.dumps({
+                    'id': 'call_1',
+                    'type': 'function',
+                    'function': {'name': 'set_next_state', 'arguments': '{"next_state": "state2"}'}
+                })
+            }]]
+        }
+
+    def test_lookup_empty_cache_skips_query(self):
+        self.assertIsNone(self.cache.lookup('state1', 'hello'))
+        self.mock_collection.query.assert_not_called()
+
+    def test_lookup_hit_and_miss(self):
+        self.cache.store('state1', 'hello', 'state2', 'Moving on.', {'id': 'call_1'})
+
+        self.mock_collection.query.return_value = self._query_result(0.01)
+        cached = self.cache.lookup('state1', 'hello!')
+        self.assertEqual(cached['next_state'], 'state2')
+        self.assertEqual(cached['assistant_response'], 'Moving on.')
+
+        self.mock_collection.query.return_value = self._query_result(0.3)
+        self.assertIsNone(self.cache.lookup('state1', 'something else'))
+
+    def test_store_evicts_least_recently_used(self):
+        self.cache.store('state1', 'a', 'state2', 'A', {})
+        self.cache.store('state1', 'b', 'state2', 'B', {})
+        self.cache.store('state1', 'c', 'state2', 'C', {})
+        self.mock_collection.delete.assert_called_once_with(ids=[ResponseCache._entry_id('state1|a')])
+
+    def test_trigger_transition_uses_cached_response(self):
+        mock_model_client = Mock()
+        state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData()),
+            model_client=mock_model_client,
+            response_cache=self.cache
+        )
+        state_machine.add_state(State(id='2', name='state2', data=StateData()))
+        self.cache.store('state1', 'hello', 'state2', 'Moving on.', {'id': 'call_1'})
+        self.mock_collection.query.return_value = self._query_result(0.0)
+
+        state_machine.trigger_transition('hello')
+
+        mock_model_client.chat.completions.create.assert_not_called()
+        self.assertEqual(state_machine.current_state.name, 'state2')
+        self.assertEqual(list(state_machine.state_history), ['state1', 'state2'])
+        self.assertEqual(state_machine.conversation_history[-1]['assistant_response'], 'Moving on.')
+
+    def test_atrigger_transition_cancels_model_call_on_cache_hit(self):
+        started = []
+
+        async def slow_create(**kwargs):
+            started.append(kwargs)
+            await asyncio.sleep(10)
+
+        mock_model_client = Mock()
+        mock_model_client.chat.completions.create = slow_create
+        state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData()),
+            model_client=mock_model_client,
+            response_cache=self.cache
+        )
+        state_machine.add_state(State(id='2', name='state2', data=StateData()))
+        self.cache.store('state1', 'hello', 'state2', 'Moving on.', {'id': 'call_1'})
+        self.mock_collection.query.return_value = self._query_result(0.0)
+
+        asyncio.run(asyncio.wait_for(state_machine.atrigger_transition('hello'), timeout=5))
+
+        self.assertEqual(len(started), 1)
+        self.assertEqual(state_machine.current_state.name, 'state2')
+        self.assertEqual(state_machine.conversation_history[-1]['assistant_response'], 'Moving on.')
+
+    def test_atrigger_transition_retrieves_failed_model_call_on_cache_hit(self):
+        async def failing_create(**kwargs):
+            raise RuntimeError('model unavailable')
+
+        def slow_query(**kwargs):
+            time.sleep(0.05)  # The model call fails before the cache answers
+            return self._query_result(0.0)
+
+        mock_model_client = Mock()
+        mock_model_client.chat.completions.create = failing_create
+        state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData()),
+            model_client=mock_model_client,
+            response_cache=self.cache
+        )
+        state_machine.add_state(State(id='2', name='state2', data=StateData()))
+        self.cache.store('state1', 'hello', 'state2', 'Moving on.', {'id': 'call_1'})
+        self.mock_collection.query.side_effect = slow_query
+        unhandled = []
+
+        async def run():
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+            await state_machine.atrigger_transition('hello')
+
+        asyncio.run(run())
+        gc.collect()
+
+        self.assertEqual(state_machine.current_state.name, 'state2')
+        self.assertEqual(unhandled, [])
+
+class TestDefaultAsyncClient(unittest.TestCase):
+    def test_one_client_per_event_loop(self):
+        async def get_twice():
+            return get_default_async_client(), get_default_async_client()
+
+        with patch('openai.AsyncOpenAI', side_effect=lambda **kwargs: Mock()), \
+                patch.dict('ai_agent_state.state._default_async_clients', clear=True):
+            first, same = asyncio.run(get_twice())
+            second, _ = asyncio.run(get_twice())
+
+        self.assertIs(first, same)
+        self.assertIsNot(first, second)
+
+    def test_env_file_is_read_on_first_client(self):
+        with patch('openai.AsyncOpenAI', side_effect=lambda **kwargs: Mock()), \
+                patch.dict('ai_agent_state.state._default_async_clients', clear=True), \
+                patch('ai_agent_state.state.load_dotenv') as mock_load_dotenv:
+            async def get_client():
+                return get_default_async_client()
+
+            asyncio.run(get_client())
+
+        mock_load_dotenv.assert_called_once()
+
+class TestSemanticCache(unittest.TestCase):
+    VECTORS = {
+        'track my order': [1.0, 0.0, 0.0],
+        'track order': [0.99, 0.1, 0.0],
+        'returns': [0.0, 1.0, 0.0],
+        'account': [0.0, 0.0, 2.0],
+    }
+
+    def setUp(self):
+        self.mock_client = Mock()
+        self.mock_client.embeddings.create.side_effect = self._embeddings
+        self.cache = SemanticCache(self.mock_client, max_entries=2)
+
+    def _embeddings(self, model, input):
+        return Mock(data=[Mock(embedding=self.VECTORS[text]) for text in input])
+
+    def test_max_entries_must_be_positive(self):
+        for max_entries in (0, -1):
+            with self.assertRaises(ValueError):
+                SemanticCache(self.mock_client, max_entries=max_entries)
+
+    def test_lookup_empty_state_skips_embedding(self):
+        self.assertIsNone(self.cache.lookup('state1', 'track my order'))
+        self.mock_client.embeddings.create.assert_not_called()
+
+    def test_lookup_hit_and_miss(self):
+        self.cache.store('state1', 'track my order', 'state2', 'Moving on.', {'id': 'call_1'})
+
+        cached = self.cache.lookup('state1', 'track order')
+        self.assertEqual(cached['next_state'], 'state2')
+        self.assertEqual(cached['assistant_response'], 'Moving on.')
+        self.assertEqual(cached['tool_call'], {'id': 'call_1'})
+        self.assertGreater(cached['similarity'], 0.92)
+
+        self.assertIsNone(self.cache.lookup('state1', 'returns'))
+        self.assertIsNone(self.cache.lookup('state2', 'track my order'))
+
+    def test_lookup_and_store_embed_input_once(self):
+        self.cache.store('state1', 'returns', 'state2', 'Returns.', {})
+        self.assertIsNone(self.cache.lookup('state1', 'track my order'))
+        self.cache.store('state1', 'track my order', 'state2', 'Moving on.', {})
+
+        self.assertEqual(self.mock_client.embeddings.create.call_count, 2)
+        _, kwargs = self.mock_client.embeddings.create.call_args
+        self.assertEqual(kwargs['model'], 'text-embedding-3-small')
+
+    def test_store_evicts_least_recently_used(self):
+        self.cache.store('state1', 'track my order', 'state2', 'A', {})
+        self.cache.store('state1', 'returns', 'state2', 'B', {})
+        self.cache.lookup('state1', 'track order')
+        self.cache.store('state1', 'account', 'state2', 'C', {})
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.lookup('state1', 'track my order')['assistant_response'], 'A')
+        self.assertEqual(self.cache.lookup('state1', 'account')['assistant_response'], 'C')
+        self.assertIsNone(self.cache.lookup('state1', 'returns'))
+
+    def test_warm_batches_embedding_requests(self):
+        cache = SemanticCache(self.mock_client)
+        entries = [
+            {'state_name': 'state1', 'user_input': text, 'next_state': 'state2',
+             'assistant_response': text.upper(), 'tool_call': {}}
+            for text in ('track my order', 'returns', 'account')
+        ]
+
+        with patch('ai_agent_state.state.EMBEDDING_BATCH_SIZE', 2):
+            cache.warm(entries)
+
+        inputs = [kwargs['input'] for _, kwargs in self.mock_client.embeddings.create.call_args_list]
+        self.assertEqual(inputs, [['track my order', 'returns'], ['account']])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.lookup('state1', 'track order')['assistant_response'], 'TRACK MY ORDER')
+        self.assertAlmostEqual(cache.lookup('state1', 'account')['similarity'], 1.0, places=5)
+
+    def test_trigger_transition_uses_cached_response(self):
+        mock_model_client = Mock()
+        state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData()),
+            model_client=mock_model_client,
+            response_cache=self.cache
+        )
+        state_machine.add_state(State(id='2', name='state2', data=StateData()))
+        self.cache.store('state1', 'track my order', 'state2', 'Moving on.', {'id': 'call_1'})
+
+        state_machine.trigger_transition('track order')
+
+        mock_model_client.chat.completions.create.assert_not_called()
+        self.assertEqual(state_machine.current_state.name, 'state2')
+        self.assertEqual(state_machine.conversation_history[-1]['assistant_response'], 'Moving on.')
+
+class TestStateMachine(unittest.TestCase):
+    def setUp(self):
+        self.mock_model_client = Mock()
+        self.state_machine = StateMachine(
+            name='TestStateMachine',
+            initial_state=State(id='1', name='state1', data=StateData()),
+            model_client=self.mock_model_client
+        )
+        self.state_machine.add_state(State(id='2', name='state2', data=StateData()))
+
+    def _mock_response(self, content, tool_name=None, arguments='{}'):
+        message = Mock()
+        message.content = content
+        message.model_dump.return_value = {'content': content}
+        if tool_name:
+            tool_call = Mock()
+            tool_call.function.name = tool_name
+            tool_call.function.arguments = arguments
+            tool_call.model_dump.return_value = {
+                'id': 'call_1',
+                'type': 'function',
+                'function': {'name': tool_name, 'arguments': arguments}
+            }
+            message.tool_calls = [tool_call]
+        else:
+            message.tool_calls = None
+        response = Mock()
+        response.choices = [Mock(message=message)]
+        return response
+
+    def test_trigger_transition_single_model_call(self):
+        self.mock_model_client.chat.completions.create.return_value = self._mock_response(
+            'Moving on.', 'set_next_state', '{"next_state": "state2"}'
+        )
+
+        self.state_machine.trigger_transition('next please')
+
+        self.assertEqual(self.mock_model_client.chat.completions.create.call_count, 1)
+        self.assertEqual(self.state_machine.current_state.name, 'state2')
+        last_turn = self.state_machine.conversation_history[-1]
+        self.assertEqual(last_turn['assistant_response'], 'Moving on.')
+        self.assertEqual(last_turn['tool_call']['id'], 'call_1')
+
+        # The recorded tool call is replayed with its result on the next turn
+        messages = self.state_machine.generate_messages('and again')
+        self.assertEqual(messages[-3]['tool_calls'][0]['id'], 'call_1')
+        self.assertEqual(messages[-2], {'role': 'tool', 'tool_call_id': 'call_1', 'content': 'State changed to state2'})
+
+    def test_trigger_transition_move_to_previous_state(self):
+        self.mock_model_client.chat.completions.create.side_effect = [
+            self._mock_response('Moving on.', 'set_next_state', '{"next_state": "state2"}'),
+            self._mock_response('Going back.', 'move_to_previous_state'),
+        ]
+
+        self.state_machine.trigger_transition('next please')
+        self.state_machine.trigger_transition('go back')
+
+        self.assertEqual(self.state_machine.current_state.name, 'state1')
+        self.assertEqual(self.state_machine.conversation_history[-1]['assistant_response'], 'Going back.')
+
+    def test_trigger_transition_without_tool_call(self):
+        self.mock_model_client.chat.completions.create.return_value = self._mock_response('Hello there.')
+
+        self.state_machine.trigger_transition('hi')
+
+        self.assertEqual(self.state_machine.current_state.name, 'state1')
+        self.assertEqual(
+            self.state_machine.conversation_history[-1],
+            {'user_input': 'hi', 'assistant_response': 'Hello there.'}
+        )
+
+    def test_static_prefix_is_reused_until_states_change(self):
+        first = self.state_machine.generate_messages('hi')[0]
+        self.assertIs(self.state_machine.generate_messages('hello')[0], first)
+
+        self.state_machine.add_state(State(id='3', name='state3', data=StateData()))
+        system_message = self.state_machine.generate_messages('hi')[0]
+        self.assertIsNot(system_message, first)
+        self.assertIn('state3', system_message['content'])
+
+    def test_state_views_follow_direct_edits(self):
+        self.assertEqual(self.state_machine.state_names, ('state1', 'state2'))
+
+        self.state_machine.states['state3'] = State(id='3', name='state3', data=StateData())
+        self.assertEqual(self.state_machine.state_names, ('state1', 'state2', 'state3'))
+        self.assertIn('state3', self.state_machine.generate_messages('hi')[0]['content'])
+
+        replacement = {'state1': self.state_machine.states['state1']}
+        self.state_machine.states = replacement
+        self.assertEqual(self.state_machine.state_names, ('state1',))
+        self.assertNotIn('state2', self.state_machine.generate_messages('hi')[0]['content'])
+        replacement['state4'] = State(id='4', name='state4', data=StateData())
+        self.assertIn('state4', self.state_machine.states_view)
+
+    def test_static_prefix_describes_transition_graph(self):
+        self.assertEqual(self.state_machine.generate_messages('hi')[1]['content'], 'No transitions are defined.')
+        cache_key = self.state_machine._prompt_cache_key
+
+        self.state_machine.add_transition(Transition(from_state='state1', to_state='state2'))
+        messages = self.state_machine.generate_messages('hi')
+        self.assertEqual(
+            messages[1],
+            {'role': 'system', 'content': 'Transitions between states: state1 -> state2; state2 -> state1.'}
+        )
+        self.assertEqual(messages[2], {'role': 'user', 'content': 'hi'})
+        self.assertNotEqual(self.state_machine._prompt_cache_key, cache_key)
+
+    def test_transition_index_follows_in_place_edits(self):
+        self.state_machine.add_state(State(id='3', name='state3', data=StateData()))
+        self.state_machine.add_transition(Transition(from_state='state1', to_state='state2'))
+        self.assertEqual([t.to_state for t in self.state_machine.find_valid_transitions('hi')], ['state2'])
+        self.assertIn('state1 -> state2;', self.state_machine.generate_messages('hi')[1]['content'])
+
+        self.state_machine.transitions[0] = Transition(from_state='state1', to_state='state3')
+
+        self.assertEqual([t.to_state for t in self.state_machine.find_valid_transitions('hi')], ['state3'])
+        self.assertIn('state1 -> state3;', self.state_machine.generate_messages('hi')[1]['content'])
+
+    def test_trigger_transition_sends_prompt_cache_key(self):
+        self.mock_model_client.base_url = httpx.URL('https://api.openai.com/v1/')
+        self.mock_model_client.chat.completions.create.return_value = self._mock_response('Hello there.')
+
+        self.state_machine.trigger_transition('hi')
+
+        _, kwargs = self.mock_model_client.chat.completions.create.call_args
+        self.assertNotIn('prompt_cache_key', kwargs)
+        self.assertEqual(kwargs['extra_body'], {'prompt_cache_key': self.state_machine._prompt_cache_key})
+        self.assertIsNotNone(self.state_machine._prompt_cache_key)
+
+    def test_prompt_cache_key_is_not_sent_to_other_servers(self):
+        self.mock_model_client.base_url = httpx.URL('http://localhost:8000/v1/')
+        self.mock_model_client.chat.completions.create.return_value = self._mock_response('Hello there.')
+
+        self.state_machine.trigger_transition('hi')
+        _, kwargs = self.mock_model_client.chat.completions.create.call_args
+        self.assertNotIn('extra_body', kwargs)
+
+        self.state_machine.send_prompt_cache_key = True
+        self.state_machine.trigger_transition('hi again')
+        _, kwargs = self.mock_model_client.chat.completions.create.call_args
+        self.assertIn('prompt_cache_key', kwargs['extra_body'])
+
+    def test_trigger_transition_falls_back_to_default_client(self):
+        shared_client = Mock()
+        shared_client.chat.completions.create.return_value = self._mock_response('Hello there.')
+        self.state_machine.model_client = None
+
+        with patch('ai_agent_state.state._default_client', shared_client):
+            self.assertIs(get_default_client(), shared_client)
+            self.state_machine.trigger_transition('hi')
+
+        shared_client.chat.completions.create.assert_called_once()
+
+    def test_conversation_history_is_bounded(self):
+        for i in range(25):
+            self.state_machine.conversation_history.append({'user_input': f'turn {i}', 'assistant_response': 'ok'})
+
+        history = self.state_machine.to_dict()['conversation_history']
+        self.assertEqual(len(history), 10)
+        self.assertEqual(history[-1]['user_input'], 'turn 24')
+
+        user_messages = [m['content'] for m in self.state_machine.generate_messages('') if m['role'] == 'user']
+        self.assertEqual(user_messages, [f'turn {i}' for i in range(20, 25)])
+
+    def test_state_history_is_bounded(self):
+        with patch('ai_agent_state.state.STATE_HISTORY_SIZE', 3):
+            state_machine = StateMachine(
+                name='TestStateMachine',
+                initial_state=State(id='1', name='state1', data=StateData())
+            )
+        state_machine.add_state(State(id='2', name='state2', data=StateData()))
+        for name in ('state2', 'state1', 'state2'):
+            state_machine.state_history.append(name)
+
+        self.assertEqual(list(state_machine.state_history), ['state2', 'state1', 'state2'])
+        state_machine.move_to_previous_state()
+        self.assertEqual(state_machine.current_state.name, 'state1')
+
+    def test_state_lookups_follow_add_state(self):
+        self.assertEqual(self.state_machine.state_names, ('state1', 'state2'))
+        self.state_machine.add_state(State(id='3', name='state3', data=StateData()))
+        self.assertEqual(self.state_machine.state_names, ('state1', 'state2', 'state3'))
+        self.assertEqual(self.state_machine.state_index['state3'], 2)
+        self.assertIs(self.state_machine.states_view['state3'], self.state_machine.states['state3'])
+        with self.assertRaises(TypeError):
+            self.state_machine.states_view['state4'] = None
+        self.assertTrue(self.state_machine.is_valid_state('state3'))
+        self.assertFalse(self.state_machine.is_valid_state('state4'))
+        self.assertFalse(self.state_machine.is_valid_state(None))
+
+    def test_bulk_add_states_and_transitions(self):
+        version = self.state_machine._states_version
+        self.state_machine.add_states([
+            State(id='3', name='state3', data=StateData()),
+            State(id='4', name='state4', data=StateData()),
+        ])
+        self.state_machine.add_transitions([
+            Transition(from_state='state2', to_state='state3'),
+            Transition(from_state='state3', to_state='state4'),
+        ])
+
+        self.assertEqual(self.state_machine._states_version, version + 1)
+        self.assertEqual(self.state_machine.state_names, ('state1', 'state2', 'state3', 'state4'))
+        self.assertEqual(
+            [(t.from_state, t.to_state) for t in self.state_machine.transitions_from('state3')],
+            [('state3', 'state2'), ('state3', 'state4')]
+        )
+
+    def test_trigger_transition_accepts_state_added_directly(self):
+        self.state_machine.states['state3'] = State(id='3', name='state3', data=StateData())
+        self.mock_model_client.chat.completions.create.return_value = self._mock_response(
+            'Moving on.', 'set_next_state', '{"next_state": "state3"}'
+        )
+
+        self.state_machine.trigger_transition('next please')
+
+        self.assertEqual(self.state_machine.current_state.name, 'state3')
+
+    def test_atrigger_transition(self):
+        mock_async_client = Mock()
+        mock_async_client.chat.completions.create = AsyncMock(return_value=self._mock_response(
+            'Moving on.', 'set_next_state', '{"next_state": "state2"}'
+        ))
+        self.state_machine.model_client = mock_async_client
+
+        asyncio.run(self.state_machine.atrigger_transition('next please'))
+
+        mock_async_client.chat.completions.create.assert_awaited_once()
+        self.assertEqual(self.state_machine.current_state.name, 'state2')
+
+    def test_trigger_transition_does_not_hold_lock_during_model_call(self):
+        response = self._mock_response('Moving on.', 'set_next_state', '{"next_state": "state2"}')
+
+        def create(**kwargs):
+            self.assertFalse(self.state_machine.lock.locked())
+            return response
+
+        self.mock_model_client.chat.completions.create.side_effect = create
+
+        self.state_machine.trigger_transition('next please')
+
+        self.assertEqual(self.state_machine.current_state.name, 'state2')
+
+    def test_from_dict_round_trip(self):
+        self.state_machine.states['state2'].data.update_metadata(llm_response='Moving on.', order_number='123')
+        data = json.loads(json.dumps(self.state_machine.to_dict()))
+
+        loaded = StateMachine.from_dict(data)
+
+        self.assertEqual(loaded.state_names, ('state1', 'state2'))
+        self.assertIs(loaded.current_state, loaded.states['state1'])
+        metadata = loaded.states['state2'].data.metadata
+        original = self.state_machine.states['state2'].data.metadata
+        self.assertEqual(metadata.llm_response, 'Moving on.')
+        self.assertEqual(metadata.custom_data, {'order_number': '123'})
+        self.assertEqual(metadata.updated_at, original.updated_at)
+
+    def test_prompts_are_stored_by_reference(self):
+        self.mock_model_client.chat.completions.create.return_value = self._mock_response(
+            'Moving on.', 'set_next_state', '{"next_state": "state2"}'
+        )
+
+        self.state_machine.trigger_transition('next please')
+
+        metadata = self.state_machine.states['state2'].data.metadata
+        self.assertEqual(len(metadata.llm_prompt), 32)
+        prompt = json.loads(self.state_machine.get_prompt(metadata.llm_prompt))
+        self.assertEqual(prompt[-1], {'role': 'user', 'content': 'next please'})
+
+        data = json.loads(json.dumps(self.state_machine.to_dict()))
+        self.assertNotIn('prompt_blobs', data)
+        self.assertEqual(dict(StateMachine.from_dict(data)._prompt_refcounts), {metadata.llm_prompt: 1})
+
+    def test_prompt_blob_released_with_last_reference(self):
+        messages = [{'role': 'user', 'content': 'same'}]
+        ref = self.state_machine._store_prompt(messages)
+        self.assertEqual(self.state_machine._store_prompt(messages), ref)
+
+        self.state_machine._release_prompt(ref)
+        self.assertIsNotNone(self.state_machine.get_prompt(ref))
+        self.state_machine._release_prompt(ref)
+        self.assertIsNone(self.state_machine.get_prompt(ref))
+        self.assertNotIn(ref, self.state_machine._prompt_refcounts)
+
+    def test_find_valid_transitions_only_checks_current_state(self):
+        other_condition = Mock(return_value=True)
+        self.state_machine.add_transition(Transition(from_state='state1', to_state='state2', condition=lambda text, sm: 'go' in text))
+        self.state_machine.add_state(State(id='3', name='state3', data=StateData()))
+        self.state_machine.add_transition(Transition(from_state='state2', to_state='state3', condition=other_condition))
+
+        self.assertEqual([t.to_state for t in self.state_machine.find_valid_transitions('go')], ['state2'])
+        self.assertEqual(self.state_machine.find_valid_transitions('stop'), [])
+        other_condition.assert_not_called()
+
+        self.state_machine.add_transition(Transition(from_state='state1', to_state='state3'))
+        self.assertEqual([t.to_state for t in self.state_machine.transitions_from('state1')], ['state2', 'state3'])